@@ -1,11 +1,39 @@
 from .tagonet import TagoDevice
+from .tagorules import RuleEngine
+from .tagotiming import BusTiming
+from .tagocaps import CapabilityRegistry, CapabilityError
+from .tagostate import DeviceState
+from .tagodeploy import Deployment
 from sqlitedict import SqliteDict
-import random
 import logging
 import time
 import threading
 import os
 
+class AddressPool(object):
+    FIRST = 3
+    LAST = 199
+
+    def __init__(self):
+        self.used = bytearray(256)
+
+    def reserve(self, addr):
+        self.used[addr] = 1
+
+    def release(self, addr):
+        self.used[addr] = 0
+
+    def is_free(self, addr):
+        return self.FIRST <= addr <= self.LAST and not self.used[addr]
+
+    def allocate(self):
+        addr = self.used.find(0, self.FIRST, self.LAST + 1)
+        if addr < 0:
+            raise Exception('No free bus addresses left')
+        self.used[addr] = 1
+        return addr
+
+
 class TagoApi(object):
     __VERSION__ = 1
 
@@ -16,7 +44,7 @@ class TagoApi(object):
         self.last_exec_time  = self.current_sec_time()
                 
 
-    def __init__(self, host, port, dbpath='.'):
+    def __init__(self, host, port, dbpath='.', link=None, rules_path=None):
         logging.info(f'Host: {host} Port: {port} DbPath: {dbpath}')
 
         if not os.path.exists(dbpath):
@@ -25,12 +53,29 @@ class TagoApi(object):
         dbfile = f'{dbpath}/devices.sqlite'
         self.host = host
         self.port = port
-        self.net = TagoDevice(host, port)
+        self.timing = BusTiming(SqliteDict(dbfile, tablename='timing', autocommit=True))
+        self.calibration_lock = threading.Lock()
+        self.net = TagoDevice(host, port, link=link, timing=self.timing)
         self.update_exec_time()
         self.devices = SqliteDict(dbfile, tablename='devices', 
                                             autocommit=True)
         self.channels = SqliteDict(dbfile, tablename='channels', 
                                             autocommit=True)
+        self.capabilities = CapabilityRegistry(SqliteDict(dbfile, tablename='models',
+                                                          autocommit=True))
+        self.rules = RuleEngine(self.net, self.devices,
+                                table=SqliteDict(dbfile, tablename='rules', autocommit=True),
+                                path=rules_path or f'{dbpath}/rules.yaml',
+                                validate=self.validate_action)
+        ## last known levels and info so dashboards have data right away
+        self.state = DeviceState(self, SqliteDict(dbfile, tablename='snapshots'))
+        ## called with lists of events, e.g. deployment progress
+        self.notify = None
+        ## called with a device id, or None for all, when registry data or
+        ## device config changed outside a REST call
+        self.on_change = None
+        self.deployment = None
+        self.deploy_lock = threading.Lock()
         if len(self.devices) == 0:
             try:
                 self.rescan_bus()
@@ -40,52 +85,83 @@ class TagoApi(object):
         for k in self.devices.keys():
                 logging.info(f'{k}: {self.devices[k]}')
 
+        self.state.reindex()
+        self.state.start()
+
         # threading.Thread(target=self.watchdog).start()    
 
     ### Scan the bus and record device_ids and matching addresses.
     ### If any device with address 0xFF or duplicate address is found
-    ### give it a new address
-    def __scan_devices(self):
-        def get_random_address():
-            return random.randrange(3, 200)
-
-        def dict_has_value(d, v):
-            for k in d.keys():
-                if d[k] == v:
-                    return True
-            return False
+    ### give it a new address. In incremental mode known devices are only
+    ### checked at their registered address and the enumeration is limited
+    ### to unassigned devices. Devices that do not answer are left out, a
+    ### full scan is only done when another device answers at an address.
+    def __scan_devices(self, incremental=False):
+        known = {d: self.devices[d]['addr'] for d in self.devices}
+
+        found = None
+        if incremental and len(known):
+            found = self.__verify_devices(known)
+        if found is None:
+            incremental = False
+            logging.info('Looking for devices...')
+            found = self.net.scanBus(0x00)
+        else:
+            logging.info('Looking for unassigned devices...')
+            found += self.net.scanBus(0xFF)
+        self.update_exec_time()
 
+        pool = AddressPool()
         duplicates = {}
         registery = {}
-        logging.info('Looking for devices...')
-
-        ## scan the bus
-        found = self.net.scanBus(0x00)
-        self.update_exec_time()
         for f in found:
             device_id = f['device_id']
             addr = f['addr']
             ## unassigned devices are tracked separately
-            if addr == 0xff or dict_has_value(registery, addr):
-                duplicates[device_id] = addr;
+            if addr == 0xff or pool.used[addr]:
+                duplicates[device_id] = addr
             else:
                 registery[device_id] = addr
+                pool.reserve(addr)
+
+        ## keep addresses of devices that are not answering right now so
+        ## they do not clash when they come back
+        for d in known:
+            if d not in registery:
+                pool.reserve(known[d])
 
-        new_addr = get_random_address()
         ## assign new addresses to duplicates and 0xFF
         for k in duplicates:
-            while dict_has_value(registery, new_addr):
-                new_addr = get_random_address()
-
+            new_addr = pool.allocate()
             self.update_exec_time()
             if self.net.assignAddress(duplicates[k], k, new_addr):
                 registery[k] = new_addr
-                new_addr = get_random_address()
                 logging.info(f'Assigned new address {new_addr} to {k}')
             else:
+                pool.release(new_addr)
                 logging.error(f'Could not assign new address {new_addr} to {k}')
 
-        return registery
+        return registery, incremental
+
+    ## returns the known devices that still answer with the right id at
+    ## their address, or None if a different device answers at one of them
+    def __verify_devices(self, known):
+        found = []
+        for d in known:
+            self.update_exec_time()
+            device_id = self.net.readDeviceId(known[d])
+            if device_id is None:
+                logging.info(f'{d} does not answer at {known[d]}')
+                continue
+            if device_id != d:
+                logging.info(f'{device_id} answers at {known[d]} instead of {d}, full scan needed')
+                return None
+            found.append({'device_id': d, 'addr': known[d]})
+        return found
+
+    def changed(self, tid=None):
+        if self.on_change is not None:
+            self.on_change(tid)
 
     def __lookup_addr(self, tid):
         if not tid in self.devices:
@@ -94,10 +170,42 @@ class TagoApi(object):
         return self.devices[tid]['addr']
 
     def rename_device(self, tid, name):
-        self.devices[tid] = {
-            'name': name,
-            'addr' : self.devices[tid]['addr']
-        }
+        self.devices[tid] = dict(self.devices[tid], name=name)
+
+    ## capabilities of a device from the model kept in its registry entry.
+    ## This never touches the bus, the model is filled in by rescans and
+    ## device_info().
+    def device_capabilities(self, tid):
+        if not tid in self.devices:
+            raise Exception(f'Device {tid} not found')
+
+        return self.capabilities.lookup(self.devices[tid].get('model'))
+
+    ## read the model of devices that do not have one yet. Devices that do
+    ## not answer keep none and get the default capabilities.
+    def __read_models(self, devices):
+        for d in devices:
+            if self.devices[d].get('model') is not None:
+                continue
+            try:
+                model = self.net.readModel(self.devices[d]['addr'])
+                self.update_exec_time()
+            except Exception as e:
+                logging.error(f'Could not read model of {d}: {e}')
+                continue
+            if model is not None:
+                self.devices[d] = dict(self.devices[d], model=model)
+                self.changed(d)
+
+    ## raises CapabilityError for channels or actions the device does not have
+    def validate_action(self, tid, channel, action):
+        CapabilityRegistry.validate(self.device_capabilities(tid), channel, action)
+
+    def set_model(self, model, capabilities):
+        self.capabilities.set_model(model, capabilities)
+
+    def list_models(self):
+        return self.capabilities.models()
 
     def rename_channel(self, tid, ch, name):
         key = f'{tid}/{ch}'
@@ -109,7 +217,7 @@ class TagoApi(object):
     def assign_addr(self, tid, src, dst):
         self.update_exec_time()
         if self.net.assignAddress(src, tid, dst):
-            devices[tid] = dst
+            self.devices[tid] = dict(self.devices[tid], addr=dst)
             return True
         else:
             return False
@@ -120,9 +228,46 @@ class TagoApi(object):
 
         self.update_exec_time()
         res.update(self.net.getInfo(addr))
-        res.update({'dimmer_chs': 8,'relay_chs': 0})
+        if self.devices[tid].get('model') != res['model']:
+            self.devices[tid] = dict(self.devices[tid], model=res['model'])
+            self.changed(tid)
+        res.update(CapabilityRegistry.channel_counts(self.device_capabilities(tid)))
+        self.state.update_info(tid, res)
         return res
 
+    ## measure bus timing for registered devices. Already calibrated
+    ## devices are skipped unless `force` is set.
+    def calibrate_bus(self, force=True):
+        with self.calibration_lock:
+            nodes = [self.devices[d]['addr'] for d in self.devices]
+            if not force:
+                nodes = [n for n in nodes if not self.timing.is_calibrated(n)]
+            if len(nodes) == 0:
+                return self.timing.stats()
+
+            self.update_exec_time()
+            try:
+                return self.net.calibrateTiming(nodes)
+            except Exception as e:
+                logging.error(f'Calibration failed: {e}')
+                return self.timing.stats()
+
+    def bus_timing(self):
+        return self.timing.stats()
+
+    def device_state(self, tid):
+        self.__lookup_addr(tid)
+        return self.state.get(tid)
+
+    def device_states(self):
+        return self.state.all()
+
+    def action_status(self):
+        return self.net.tracker.status()
+
+    def bridge_status(self):
+        return self.net.link.metrics()
+
     def identify_device(self, tid):
         self.net.identify(self.__lookup_addr(tid))
         self.update_exec_time()
@@ -131,8 +276,9 @@ class TagoApi(object):
         self.net.reboot(self.__lookup_addr(tid))
         self.update_exec_time()
 
-    def device_action(self, tid, channel, action, value, rate):
+    def device_action(self, tid, channel, action, value, rate, wait=True):
         addr = self.__lookup_addr(tid)
+        self.validate_action(tid, channel, action)
         if (value < 0): value = 0
         if (value > 100): value = 100
 
@@ -142,46 +288,84 @@ class TagoApi(object):
             action = action.upper()
             action = TagoDevice.Actions[action]
             
-            self.net.directAction(addr, channel, action.value, value, rate)
+            self.net.directAction(addr, channel, action.value, value, rate, wait=wait)
             self.update_exec_time()
         except Exception as e: 
             logging.error(f'Action failed {e}')
             pass
 
-    ## rescan all devices on the bus
-    def rescan_bus(self):
-        results = self.__scan_devices()
+    ## start pushing a whole-site config in the background. Only one
+    ## deployment runs at a time.
+    def deploy_config(self, config):
+        with self.deploy_lock:
+            if self.deployment is not None and self.deployment.finished is None:
+                raise Exception(f'Deployment {self.deployment.id} is still running')
+            self.deployment = Deployment(self, config, notify=self.notify)
+            threading.Thread(name='Config Deployment', target=self.deployment.run,
+                             daemon=True).start()
+            return self.deployment.id
+
+    def deploy_status(self):
+        if self.deployment is None:
+            return {}
+        return self.deployment.result()
+
+    ## rescan the bus and return what changed against the registry. With
+    ## `prune` devices that were not found are removed from the registry.
+    def rescan_bus(self, incremental=False, prune=False):
+        old = {d: self.devices[d]['addr'] for d in self.devices}
+        results, incremental = self.__scan_devices(incremental)
 
-        # for d in self.devices:
-            # if not d in results:
-            #     del self.devices[d]
-        
         for d in results:
             if d in self.devices:
                 name = self.devices[d].get('name', d)
             else:
                 name = d
 
-            self.devices[d] = {
-                'name': name,
-                'addr': results[d]
-            }
+            if old.get(d) != results[d]:
+                self.devices[d] = dict(self.devices.get(d, {}),
+                                       name=name, addr=results[d])
+
+        diff = {
+            'mode': 'incremental' if incremental else 'full',
+            'added': {d: results[d] for d in results if d not in old},
+            'moved': {d: {'from': old[d], 'to': results[d]} for d in results
+                            if d in old and old[d] != results[d]},
+            'missing': {d: old[d] for d in old if d not in results},
+            'devices': results,
+        }
 
-        return results
+        if prune:
+            for d in diff['missing']:
+                logging.info(f'Removing {d} from the registry')
+                del self.devices[d]
+                for key in [k for k in self.channels.keys() if k.startswith(f'{d}/')]:
+                    del self.channels[key]
+
+        self.__read_models(results)
+
+        ## rules resolve device ids to addresses at compile time
+        self.rules.reload()
+        self.state.reindex()
+
+        return diff
 
     ## list all devices
     def list_devices(self):
         results = {}
         for d in self.devices:
+            capabilities = self.device_capabilities(d)
             name = self.devices[d]['name']
             results[d] = {'alias': name, 'addr': self.devices[d]['addr'],
+                           'model': self.devices[d].get('model'),
                            'dimmers': {}}
-            for i in range(8):
-                key = f'{d}/{i+1}'
-                results[d]['dimmers'][key] = {'ch': i+1}
+            for c in capabilities['channels']:
+                key = f'{d}/{c["ch"]}'
+                group = results[d].setdefault(f'{c["type"]}s', {})
+                group[key] = {'ch': c['ch'], 'actions': c['actions']}
 
                 ## lookup channel alias if it exists
                 if key in self.channels:
-                    results[d]['dimmers'][key]['alias'] = self.channels[key]['name']
+                    group[key]['alias'] = self.channels[key]['name']
 
         return results
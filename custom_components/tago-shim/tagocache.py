@@ -0,0 +1,88 @@
+import json
+import time
+import hashlib
+import threading
+
+
+class ResponseCache(object):
+    """Single-flight cache for read-only REST responses.
+
+    Concurrent calls for the same key share one computation, the first
+    caller runs it and the others wait for its result (or its exception).
+    Results are kept until `ttl` runs out or the key is invalidated, with
+    an ETag over the JSON encoding for conditional GETs. A result that was
+    computed while its key was invalidated is handed out but not stored.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.inflight = {}
+        ## bumped per key by invalidate(key), `epoch` by invalidate()
+        self.generations = {}
+        self.epoch = 0
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'invalidations': 0}
+
+    @staticmethod
+    def etag(value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+    ## returns (value, etag)
+    def get(self, key, ttl, compute):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() < entry['expires']:
+                self.stats['hits'] += 1
+                return entry['value'], entry['etag']
+
+            flight = self.inflight.get(key)
+            if flight is None:
+                flight = {'done': threading.Event(), 'epoch': self.epoch,
+                          'generation': self.generations.get(key, 0)}
+                self.inflight[key] = flight
+                leader = True
+                self.stats['misses'] += 1
+            else:
+                leader = False
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value'], flight['etag']
+
+        try:
+            value = compute()
+            flight['value'] = value
+            flight['etag'] = self.etag(value)
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if 'error' not in flight and flight['epoch'] == self.epoch and \
+                   flight['generation'] == self.generations.get(key, 0):
+                    self.entries[key] = {'value': flight['value'], 'etag': flight['etag'],
+                                         'expires': time.monotonic() + ttl}
+            flight['done'].set()
+
+        return flight['value'], flight['etag']
+
+    ## drop the given keys, or everything. Computations of those keys
+    ## already running will not be stored.
+    def invalidate(self, *keys):
+        with self.lock:
+            self.stats['invalidations'] += 1
+            if len(keys):
+                for k in keys:
+                    self.entries.pop(k, None)
+                    self.generations[k] = self.generations.get(k, 0) + 1
+            else:
+                self.epoch += 1
+                self.entries = {}
+                self.generations = {}
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), inflight=len(self.inflight))
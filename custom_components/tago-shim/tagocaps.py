@@ -0,0 +1,92 @@
+from .tagonet import TagoDevice
+
+ACTIONS = [a.name for a in TagoDevice.Actions]
+
+## what every device that predates the registry looks like: 8 dimmer
+## channels
+DEFAULT_CAPABILITIES = {
+    'channels': [{'ch': i + 1, 'type': 'dimmer', 'actions': ACTIONS} for i in range(8)],
+}
+
+## built-in models, keyed by the model code from register 0x400 as
+## formatted by TagoDevice.getInfo(). None are known yet, models are
+## added through the `models` table.
+MODELS = {
+}
+
+
+class CapabilityError(ValueError):
+    pass
+
+
+class CapabilityRegistry(object):
+    """Maps model codes to what a device can do.
+
+    Built-in models can be overridden or extended through `table`, which
+    lives next to the device registry. Unknown models get
+    DEFAULT_CAPABILITIES.
+    """
+    def __init__(self, table=None):
+        self.table = table
+
+    def lookup(self, model):
+        if model is not None and self.table is not None and model in self.table:
+            return self.table[model]
+        return MODELS.get(model, DEFAULT_CAPABILITIES)
+
+    def set_model(self, model, capabilities):
+        if self.table is None:
+            raise CapabilityError('No model table configured')
+        if not isinstance(model, str) or not model:
+            raise CapabilityError(f'Invalid model {model!r}')
+        self.table[model.upper()] = self.normalize(capabilities)
+
+    def models(self):
+        res = dict(MODELS)
+        if self.table is not None:
+            res.update({k: self.table[k] for k in self.table.keys()})
+        return res
+
+    ## accepts either a full channel list or the short form
+    ## {'dimmer_chs': 4, 'relay_chs': 2}
+    @staticmethod
+    def normalize(capabilities):
+        if not isinstance(capabilities, dict):
+            raise CapabilityError('Capabilities must be an object')
+        try:
+            channels = capabilities.get('channels')
+            if channels is None:
+                channels = []
+                for kind in ('dimmer', 'relay'):
+                    for i in range(int(capabilities.get(f'{kind}_chs', 0))):
+                        channels.append({'ch': len(channels) + 1, 'type': kind, 'actions': ACTIONS})
+            for c in channels:
+                actions = [a.upper() for a in c.get('actions', ACTIONS)]
+                unknown = [a for a in actions if a not in ACTIONS]
+                if len(unknown):
+                    raise CapabilityError(f'Unknown actions {unknown}')
+                c['actions'] = actions
+        except CapabilityError:
+            raise
+        except (AttributeError, TypeError, ValueError) as e:
+            raise CapabilityError(f'Invalid capabilities: {e}') from e
+        return {
+            'channels': channels,
+        }
+
+    @staticmethod
+    def channel_counts(capabilities):
+        res = {'dimmer_chs': 0, 'relay_chs': 0}
+        for c in capabilities['channels']:
+            key = f'{c["type"]}_chs'
+            res[key] = res.get(key, 0) + 1
+        return res
+
+    @staticmethod
+    def validate(capabilities, channel, action):
+        for c in capabilities['channels']:
+            if c['ch'] == channel:
+                if action.upper() not in c['actions']:
+                    raise CapabilityError(f'Channel {channel} does not support {action}')
+                return
+        raise CapabilityError(f'No channel {channel}')
@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import logging
+import resource
+import threading
+
+## capture file: magic, start time as a double, then one record per frame
+## made of the microseconds since the previous frame, the frame length and
+## the raw frame as read from the bridge (without the MBAP header)
+MAGIC = b'TGCAP\x01'
+HEADER = struct.Struct('<d')
+RECORD = struct.Struct('<IH')
+
+
+class CaptureWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.last = time.monotonic()
+        self.frames = 0
+        self.file.write(MAGIC + HEADER.pack(time.time()))
+
+    def write(self, frame):
+        now = time.monotonic()
+        with self.lock:
+            if self.file is None:
+                return
+            delta = min(int((now - self.last) * 1000000), 0xFFFFFFFF)
+            self.last = now
+            self.file.write(RECORD.pack(delta, len(frame)) + frame)
+            self.frames += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.file = None
+        return {'file': self.path, 'frames': self.frames}
+
+
+def read_capture(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a capture file')
+
+    offset = len(MAGIC) + HEADER.size
+    frames = []
+    while offset + RECORD.size <= len(data):
+        delta, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        frames.append((delta / 1000000, data[offset:offset + length]))
+        offset += length
+    return frames
+
+
+class WebSocketClient(object):
+    """A WebSocket client on its own thread, connected to the replay's
+    TagoEventServer over loopback. Latency is measured from when the frame
+    was parsed to when the message is decoded here.
+    """
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f'GET / HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+                           f'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                           f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = bytes()
+        while not response.endswith(b'\r\n\r\n'):
+            chunk = self.sock.recv(1)
+            if not chunk:
+                raise ConnectionError('WebSocket handshake failed')
+            response += chunk
+        if b' 101 ' not in response.split(b'\r\n')[0]:
+            raise ConnectionError(f'WebSocket handshake failed: {response[:40]}')
+
+        self.received = 0
+        self.latencies = []
+        self.thread = threading.Thread(name='Replay Client', target=self.__consume, daemon=True)
+        self.thread.start()
+
+    def __recv_exact(self, size):
+        data = bytes()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+    def __consume(self):
+        try:
+            while True:
+                header = self.__recv_exact(2)
+                length = header[1] & 0x7f
+                if length == 126:
+                    length = struct.unpack('>H', self.__recv_exact(2))[0]
+                elif length == 127:
+                    length = struct.unpack('>Q', self.__recv_exact(8))[0]
+                payload = self.__recv_exact(length)
+                ## close frame
+                if header[0] & 0x0f == 8:
+                    return
+                events = json.loads(payload)
+                self.latencies.append(time.time() - events[0]['ts'] / 1000)
+                self.received += 1
+        except (OSError, ConnectionError):
+            return
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+
+class DryRunNet(object):
+    """Stands in for TagoDevice so rules run without sending anything."""
+    def __init__(self):
+        self.actions = 0
+
+    def directAction(self, *args, **kwargs):
+        self.actions += 1
+
+
+class Replay(object):
+    """Feeds a capture through the event worker of a TagoEventServer.
+
+    Each frame goes through TagoEvents.parseFrame and
+    TagoEventServer.handle, so rules (on a DryRunNet), action tracking and
+    the fan-out run as they do live, and messages reach `clients` real
+    WebSocket connections through SimpleWebSocketServer's send queues.
+    `speed` scales the recorded timing, 1 replays in real time and 0 as
+    fast as possible.
+    """
+    CONNECT_TIMEOUT = 10
+    DELIVERY_TIMEOUT = 30
+
+    def __init__(self, path, speed=1.0, clients=50, loops=1, rules=None):
+        self.path = path
+        self.speed = speed
+        self.clients = clients
+        self.loops = loops
+        self.rules = rules
+
+    @staticmethod
+    def __rss_kb():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+        except (OSError, ValueError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    @staticmethod
+    def __wait(condition, timeout):
+        end = time.monotonic() + timeout
+        while not condition() and time.monotonic() < end:
+            time.sleep(0.01)
+        return condition()
+
+    def run(self):
+        from .tagonet import TagoEvents
+        from .tagoserver import TagoEventServer
+        from .tagotrack import ActionTracker
+
+        frames = read_capture(self.path)
+        stop = threading.Event()
+        server = TagoEventServer('127.0.0.1', 0, None, None, stop)
+        net = DryRunNet()
+        server.rules = self.rules.with_net(net) if self.rules is not None else None
+        server.tracker = ActionTracker()
+
+        backlog = {'max': 0}
+
+        def serve():
+            while not stop.is_set():
+                server.serveonce()
+                queued = [len(c.sendq) for c in list(server.connections.values())]
+                backlog['max'] = max([backlog['max']] + queued)
+
+        serving = threading.Thread(name='Replay Server', target=serve, daemon=True)
+        serving.start()
+        port = server.serversocket.getsockname()[1]
+        clients = [WebSocketClient(port) for i in range(self.clients)]
+        rss_start = self.__rss_kb()
+
+        ## keep the parser's per event logging out of the measurement
+        level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.WARNING)
+
+        events = 0
+        messages = 0
+        errors = 0
+        try:
+            if not self.__wait(lambda: len(server.clients) == len(clients), self.CONNECT_TIMEOUT):
+                raise RuntimeError(f'Only {len(server.clients)} of {len(clients)} clients connected')
+
+            start = time.perf_counter()
+            due = start
+            for loop in range(self.loops):
+                for delta, frame in frames:
+                    if self.speed:
+                        due += delta / self.speed
+                        delay = due - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+
+                    try:
+                        result = TagoEvents.parseFrame(frame)
+                        if len(result):
+                            server.handle(result)
+                    except Exception:
+                        errors += 1
+                        continue
+                    if len(result):
+                        events += len(result)
+                        messages += 1
+            fed = time.perf_counter() - start
+
+            self.__wait(lambda: all(c.received >= messages for c in clients), self.DELIVERY_TIMEOUT)
+            if server.rules is not None:
+                server.rules.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            logging.getLogger().setLevel(level)
+            for c in clients:
+                c.close()
+            stop.set()
+            serving.join()
+            server.close()
+
+        latencies = sorted(l for c in clients for l in c.latencies)
+
+        def percentile(p):
+            if not len(latencies):
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+
+        return {
+            'frames': len(frames) * self.loops,
+            'parse_errors': errors,
+            'events': events,
+            'messages': messages,
+            'clients': self.clients,
+            'speed': self.speed or 'max',
+            'feed_seconds': round(fed, 3),
+            'total_seconds': round(elapsed, 3),
+            'events_per_sec': round(events / fed, 1) if fed else None,
+            'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95),
+                           'p99': percentile(0.99), 'max': percentile(1)},
+            'delivered': sum(c.received for c in clients),
+            'undelivered': messages * len(clients) - sum(c.received for c in clients),
+            'max_send_queue': backlog['max'],
+            'rule_actions': net.actions,
+            'rss_growth_kb': self.__rss_kb() - rss_start,
+        }
+
+
+## python tagocapture.py <capture> [speed] [clients] [loops]
+if __name__ == '__main__':
+    import importlib.util
+
+    ## load the modules as a package without running __init__.py, which
+    ## needs Home Assistant
+    here = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_loader('tagoshim', loader=None, is_package=True)
+    package = importlib.util.module_from_spec(spec)
+    package.__path__ = [here]
+    sys.modules['tagoshim'] = package
+    capture = importlib.import_module('tagoshim.tagocapture')
+
+    args = sys.argv[1:]
+    report = capture.Replay(args[0],
+                            speed=float(args[1]) if len(args) > 1 else 1.0,
+                            clients=int(args[2]) if len(args) > 2 else 50,
+                            loops=int(args[3]) if len(args) > 3 else 1).run()
+    print(json.dumps(report, indent=2))
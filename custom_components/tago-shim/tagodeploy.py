@@ -0,0 +1,157 @@
+from .tagonet import TagoDevice, Config
+import time
+import uuid
+import logging
+import threading
+
+
+class Deployment(object):
+    """Pushes a whole-site configuration to every device on the bus.
+
+    All register images are built and validated before the first write, an
+    invalid config never touches the bus. Devices whose 0x402 version
+    already matches are skipped. Writes run at background priority, and a
+    device that fails verification gets its previous image back. Progress
+    goes to `notify` as 'deploy_progress' events.
+    """
+    FINISHED = ('unchanged', 'verified', 'failed', 'restored', 'restore_failed')
+
+    def __init__(self, api, config, notify=None):
+        self.id = uuid.uuid4().hex[:8]
+        self.api = api
+        self.net = api.net
+        self.config = Config(config)
+        self.notify = notify
+        self.status = 'pending'
+        self.started = None
+        self.finished = None
+        self.devices = {}
+        ## result() is read by the REST thread while run() is going
+        self.lock = threading.Lock()
+
+    def __report(self, tid, status, **extra):
+        with self.lock:
+            entry = self.devices.setdefault(tid, {})
+            entry.update(extra, status=status)
+            done = len([d for d in self.devices.values()
+                        if d['status'] in self.FINISHED])
+        logging.info(f'Deployment {self.id}: {tid} {status}')
+        if self.notify is not None:
+            try:
+                self.notify([{'event': 'deploy_progress', 'ts': int(time.time() * 1000),
+                              'deployment': self.id, 'device_id': tid, 'status': status,
+                              'done': done, 'total': len(self.config.devices), **extra}])
+            except Exception as e:
+                logging.error(f'Progress report failed: {e}')
+
+    ## build every image up front. Returns the plan and the errors per device.
+    def plan(self):
+        plan = []
+        errors = {}
+        for tid, config in self.config.devices.items():
+            try:
+                if tid in self.api.devices:
+                    node = self.api.devices[tid]['addr']
+                elif 'modbus_address' in config:
+                    node = int(str(config['modbus_address']), 0)
+                else:
+                    raise Exception('Device is not registered and has no modbus_address')
+
+                regs, crc = TagoDevice.buildConfigImage(config)
+                ## channel 0 addresses the whole device
+                if tid in self.api.devices:
+                    for n in config['events']:
+                        channel = int(str(n['channel']), 0)
+                        action = TagoDevice.Actions(int(str(n.get('action_code', -1)), 0)).name \
+                                    if 'action_code' in n else n['action'].upper()
+                        if channel:
+                            self.api.validate_action(tid, channel, action)
+                plan.append({'device_id': tid, 'node': node, 'regs': regs, 'crc': crc})
+            except Exception as e:
+                errors[tid] = str(e)
+        return plan, errors
+
+    def run(self):
+        self.started = round(time.time())
+        self.status = 'validating'
+        try:
+            plan, errors = self.plan()
+            if len(errors):
+                for tid, error in errors.items():
+                    self.__report(tid, 'invalid', error=error)
+                self.status = 'invalid'
+                self.finished = round(time.time())
+                return self.result()
+
+            self.status = 'running'
+            for item in plan:
+                self.__report(item['device_id'], 'queued', node=item['node'])
+            for item in plan:
+                self.__deploy(item)
+
+            with self.lock:
+                failed = [d for d in self.devices.values() if d['status'] in ('failed', 'restored', 'restore_failed')]
+            self.status = 'failed' if len(failed) else 'done'
+            self.finished = round(time.time())
+            ## config versions changed, cached device info is stale
+            self.api.changed()
+            return self.result()
+        except Exception as e:
+            logging.error(f'Deployment {self.id} aborted: {e!r}')
+            self.status = 'failed'
+            ## some devices may have been written already
+            self.api.changed()
+            raise
+        finally:
+            ## always finish, deploy_config refuses while one is running
+            if self.finished is None:
+                self.finished = round(time.time())
+
+    def __deploy(self, item):
+        tid, node, regs, crc = item['device_id'], item['node'], item['regs'], item['crc']
+        try:
+            version = self.net.readConfigVersion(node)
+            self.api.update_exec_time()
+        except Exception as e:
+            self.__report(tid, 'failed', error=f'Device not reachable: {e}')
+            return
+
+        if version == crc:
+            self.__report(tid, 'unchanged', version=f'{crc:04x}')
+            return
+
+        try:
+            previous = self.net.readConfigImage(node, background=True)
+        except Exception as e:
+            self.__report(tid, 'failed', error=f'Could not back up event table: {e}')
+            return
+
+        self.__report(tid, 'writing', version=f'{crc:04x}')
+        try:
+            self.net.writeConfigImage(node, regs, crc, background=True)
+            if self.net.readConfigVersion(node) != crc or \
+               self.net.readConfigImage(node, background=True) != regs:
+                raise Exception('Read back does not match')
+            self.api.update_exec_time()
+            self.__report(tid, 'verified')
+            return
+        except Exception as e:
+            error = str(e)
+            logging.error(f'Deployment {self.id}: {tid} failed verification: {e}')
+
+        try:
+            self.net.writeConfigImage(node, previous, version, background=True)
+            self.__report(tid, 'restored', error=error, version=f'{version:04x}')
+        except Exception as e:
+            self.__report(tid, 'restore_failed', error=f'{error}, restore: {e}')
+
+    def result(self):
+        with self.lock:
+            devices = {tid: dict(d) for tid, d in self.devices.items()}
+        return {
+            'deployment': self.id,
+            'status': self.status,
+            'started': self.started,
+            'finished': self.finished,
+            'devices': devices,
+        }
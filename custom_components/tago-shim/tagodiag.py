@@ -0,0 +1,221 @@
+import os
+import re
+import sys
+import time
+import threading
+import tracemalloc
+from .tagocapture import CaptureWriter
+
+
+class TracedLock(object):
+    """A Lock that can record wait and hold times per call site.
+
+    With tracing off acquire/release go straight to the wrapped lock, the
+    only cost is one attribute check.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.tracing = False
+        self.sites = {}
+        self.holder = None
+        self.acquired_at = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.tracing:
+            return self.lock.acquire(blocking, timeout)
+
+        f = sys._getframe(1)
+        site = f'{f.f_code.co_name}:{f.f_lineno}'
+        start = time.perf_counter()
+        res = self.lock.acquire(blocking, timeout)
+        now = time.perf_counter()
+        s = self.__site(site)
+        s['count'] += 1
+        s['wait_total'] += now - start
+        s['wait_max'] = max(s['wait_max'], now - start)
+        if res:
+            self.holder = site
+            self.acquired_at = now
+        return res
+
+    def release(self):
+        holder = self.holder
+        if holder is not None:
+            held = time.perf_counter() - self.acquired_at
+            self.holder = None
+            s = self.__site(holder)
+            s['hold_total'] += held
+            s['hold_max'] = max(s['hold_max'], held)
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __site(self, site):
+        return self.sites.setdefault(site, {'count': 0, 'wait_total': 0, 'wait_max': 0,
+                                            'hold_total': 0, 'hold_max': 0})
+
+    def start(self):
+        self.sites = {}
+        self.tracing = True
+
+    def stop(self):
+        self.tracing = False
+
+    def stats(self):
+        res = {}
+        for site, s in list(self.sites.items()):
+            res[site] = {
+                'count': s['count'],
+                'wait_total_ms': round(s['wait_total'] * 1000, 2),
+                'wait_max_ms': round(s['wait_max'] * 1000, 2),
+                'hold_total_ms': round(s['hold_total'] * 1000, 2),
+                'hold_max_ms': round(s['hold_max'] * 1000, 2),
+            }
+        return {'tracing': self.tracing, 'holder': self.holder, 'sites': res}
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all threads from a background thread.
+
+    Results are collapsed stacks (`thread;outer;...;inner count`), one set
+    per thread, which flame graph tools read directly.
+    """
+    def __init__(self):
+        self.thread = None
+        self.running = threading.Event()
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+
+    def start(self, interval=0.005):
+        if self.thread is not None:
+            return False
+        self.stacks = {}
+        self.samples = 0
+        self.started = time.monotonic()
+        self.running.set()
+        self.thread = threading.Thread(name='Profiler', target=self.__sample,
+                                       args=(interval,), daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if self.thread is None:
+            return self.collapsed()
+        self.running.clear()
+        self.thread.join()
+        self.thread = None
+        return self.collapsed()
+
+    def __sample(self, interval):
+        me = threading.get_ident()
+        while self.running.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                    frame = frame.f_back
+                thread = names.get(ident, str(ident))
+                key = ';'.join(reversed(stack))
+                counts = self.stacks.setdefault(thread, {})
+                counts[key] = counts.get(key, 0) + 1
+            self.samples += 1
+            time.sleep(interval)
+
+    def collapsed(self):
+        return {
+            'running': self.thread is not None,
+            'samples': self.samples,
+            'seconds': round(time.monotonic() - self.started, 1) if self.started else 0,
+            'threads': {t: [f'{t};{k} {v}' for k, v in sorted(c.items(), key=lambda i: -i[1])]
+                        for t, c in list(self.stacks.items())},
+        }
+
+
+class MemoryTracer(object):
+    def start(self, frames=5):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def snapshot(self, top=20):
+        if not tracemalloc.is_tracing():
+            return {'tracing': False, 'top': []}
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        )).statistics('lineno')
+        return {
+            'tracing': True,
+            'current_kb': round(current / 1024, 1),
+            'peak_kb': round(peak / 1024, 1),
+            'top': [{'site': str(s.traceback[0]), 'size_kb': round(s.size / 1024, 1),
+                     'count': s.count} for s in stats[:top]],
+        }
+
+
+class Diagnostics(object):
+    ## capture files are plain names inside capture_dir
+    CAPTURE_NAME = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+
+    def __init__(self, locks=None, server=None, capture_dir='captures'):
+        self.profiler = SamplingProfiler()
+        self.memory = MemoryTracer()
+        self.locks = locks or {}
+        self.server = server
+        self.capture_dir = capture_dir
+
+    ## resolve a capture file name from a request, raises ValueError for
+    ## anything but a plain file name
+    def capture_path(self, name):
+        if not isinstance(name, str) or not self.CAPTURE_NAME.match(name):
+            raise ValueError(f'Invalid capture name {name!r}')
+        directory = os.path.realpath(self.capture_dir)
+        path = os.path.realpath(os.path.join(directory, name))
+        if os.path.dirname(path) != directory:
+            raise ValueError(f'Invalid capture name {name!r}')
+        return path
+
+    ## record raw bridge frames for tagocapture.Replay into capture_dir
+    def start_capture(self, name):
+        path = self.capture_path(name)
+        os.makedirs(self.capture_dir, exist_ok=True)
+        self.stop_capture()
+        self.server.capture = CaptureWriter(path)
+        if getattr(self.server, 'events', None) is not None:
+            self.server.events.recorder = self.server.capture
+
+    def stop_capture(self):
+        capture = self.server.capture
+        if capture is None:
+            return {}
+        self.server.capture = None
+        if getattr(self.server, 'events', None) is not None:
+            self.server.events.recorder = None
+        return capture.close()
+
+    def start_locks(self):
+        for l in self.locks.values():
+            l.start()
+
+    def stop_locks(self):
+        for l in self.locks.values():
+            l.stop()
+
+    def lock_stats(self):
+        return {k: l.stats() for k, l in self.locks.items()}
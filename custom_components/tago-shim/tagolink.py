@@ -0,0 +1,266 @@
+import os
+import time
+import random
+import socket
+import logging
+from threading import Lock
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+
+## errors that mean the bridge itself is unreachable, as opposed to a
+## node on the bus not answering
+LINK_ERRORS = (ConnectionException, OSError)
+
+
+class BridgeUnavailable(Exception):
+    pass
+
+
+class LinkSettings(object):
+    def __init__(self, keepalive_idle=5, keepalive_interval=5, keepalive_count=2,
+                 connect_timeout=5, backoff_base=0.5, backoff_max=30,
+                 breaker_threshold=3, breaker_reset=10, silent_nodes=3, silent_window=60):
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.connect_timeout = connect_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.silent_nodes = silent_nodes
+        self.silent_window = silent_window
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        settings = cls()
+        ## times are in seconds and may have fractions, counts are whole
+        for name, env, kind in (('keepalive_idle', 'MB_KEEPALIVE_IDLE', float),
+                                ('keepalive_interval', 'MB_KEEPALIVE_INTERVAL', float),
+                                ('keepalive_count', 'MB_KEEPALIVE_COUNT', int),
+                                ('connect_timeout', 'MB_CONNECT_TIMEOUT', float),
+                                ('backoff_base', 'MB_BACKOFF_BASE', float),
+                                ('backoff_max', 'MB_BACKOFF_MAX', float),
+                                ('breaker_threshold', 'MB_BREAKER_THRESHOLD', int),
+                                ('breaker_reset', 'MB_BREAKER_RESET', float),
+                                ('silent_nodes', 'MB_SILENT_NODES', int),
+                                ('silent_window', 'MB_SILENT_WINDOW', float)):
+            if env in environ:
+                setattr(settings, name, kind(float(environ[env])))
+        return settings
+
+    def apply_keepalive(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        ## linux names first, then the macOS equivalent of TCP_KEEPIDLE
+        for opt, value in (('TCP_KEEPIDLE', self.keepalive_idle),
+                           ('TCP_KEEPINTVL', self.keepalive_interval),
+                           ('TCP_KEEPCNT', self.keepalive_count),
+                           ('TCP_KEEPALIVE', self.keepalive_idle)):
+            if not hasattr(socket, opt):
+                continue
+            try:
+                ## the socket options take whole seconds, at least one
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), max(1, round(value)))
+            except OSError:
+                pass
+
+
+class Backoff(object):
+    def __init__(self, base=0.5, maximum=30):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    ## equal jitter: half of the exponential step is fixed, the other half
+    ## random, so reconnecting channels never line up on the bridge
+    def next(self):
+        step = min(self.maximum, self.base * (2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return step / 2 + random.uniform(0, step / 2)
+
+
+class BridgeLink(object):
+    """Connection health shared by every channel talking to one bridge.
+
+    Channels report connects, successes and link failures here. After
+    `breaker_threshold` consecutive failures the breaker opens and command
+    calls fail immediately with BridgeUnavailable until `breaker_reset`
+    seconds have passed, after which a single probe call is let through.
+
+    pymodbus returns a missing response instead of raising, and a bridge
+    that went away without a reset looks the same as a dead node. So
+    `silent_nodes` different nodes not answering in a row also count as a
+    link failure, as long as each of them answered in the last
+    `silent_window` seconds and nothing came from the bridge in between,
+    neither a response nor an event. Nodes that are simply offline never
+    count.
+    """
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host, port, settings=None):
+        self.host = host
+        self.port = port
+        self.settings = settings or LinkSettings()
+        self.lock = Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.outage_started = None
+        self.probing = False
+        self.silent = set()
+        ## last response per node
+        self.answered = {}
+        self.stats = {
+            'outages': 0,
+            'outage_seconds': 0.0,
+            'rejected': 0,
+            'failures': 0,
+            'last_error': None,
+            'channels': {},
+        }
+
+    def backoff(self):
+        return Backoff(self.settings.backoff_base, self.settings.backoff_max)
+
+    def __channel(self, channel):
+        return self.stats['channels'].setdefault(channel, {'connects': 0,
+                                                           'reconnects': 0,
+                                                           'failures': 0,
+                                                           'last_connect': None})
+
+    ## raise BridgeUnavailable if the breaker does not let a call through
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.settings.breaker_reset:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+            self.stats['rejected'] += 1
+        raise BridgeUnavailable(f'Bridge {self.host}:{self.port} is unavailable')
+
+    def record_connect(self, channel):
+        with self.lock:
+            ch = self.__channel(channel)
+            if ch['connects']:
+                ch['reconnects'] += 1
+            ch['connects'] += 1
+            ch['last_connect'] = round(time.time())
+            ## a connect alone does not close an open breaker, only a
+            ## response does
+            if self.state != self.CLOSED:
+                return
+        self.record_success(channel)
+
+    def record_success(self, channel):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info(f'Bridge {self.host}:{self.port} is back after '
+                             f'{round(time.monotonic() - self.outage_started, 1)}s')
+                self.stats['outage_seconds'] += time.monotonic() - self.outage_started
+                self.outage_started = None
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+            self.silent.clear()
+
+    ## a node answered
+    def record_answer(self, node):
+        with self.lock:
+            self.answered[node] = time.monotonic()
+
+    ## anything at all came from the bridge, e.g. an event frame
+    def record_activity(self, channel):
+        with self.lock:
+            self.silent.clear()
+
+    def record_failure(self, channel, error):
+        with self.lock:
+            self.__channel(channel)['failures'] += 1
+            self.stats['failures'] += 1
+            self.stats['last_error'] = f'{channel}: {error}'
+            self.failures += 1
+            self.probing = False
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN or self.failures >= self.settings.breaker_threshold:
+                if self.state == self.CLOSED:
+                    logging.error(f'Bridge {self.host}:{self.port} is down: {error}')
+                    self.stats['outages'] += 1
+                    self.outage_started = now
+                self.state = self.OPEN
+                self.opened_at = now
+
+    def __probe_failed(self, channel, error):
+        with self.lock:
+            probing = self.probing
+        if probing:
+            self.record_failure(channel, f'probe failed: {error!r}')
+
+    ## a node did not answer. Returns True if this counted as a link
+    ## failure, the caller should drop its socket then. `expected` misses
+    ## (end of a scan, a node rebooting) only count while probing.
+    def record_silence(self, channel, node, error, expected=False):
+        with self.lock:
+            if self.state == self.CLOSED:
+                if expected:
+                    return False
+                ## offline nodes say nothing about the bridge
+                answered = self.answered.get(node)
+                if answered is None or time.monotonic() - answered > self.settings.silent_window:
+                    return False
+                self.silent.add(node)
+                if len(self.silent) < self.settings.silent_nodes:
+                    return False
+            nodes = ', '.join(f'0x{n:02x}' for n in sorted(self.silent))
+            self.silent.clear()
+            ## the misses already are the consecutive failures, open now
+            self.failures = max(self.failures, self.settings.breaker_threshold - 1)
+        self.record_failure(channel, f'no response from {nodes}: {error}')
+        return True
+
+    ## run fn through the breaker. `connect` makes sure the channel's
+    ## socket is up before the call goes out.
+    def run(self, channel, connect, fn, *args, **kwargs):
+        self.allow()
+        try:
+            connect()
+            result = fn(*args, **kwargs)
+        except LINK_ERRORS as e:
+            self.record_failure(channel, e)
+            raise BridgeUnavailable(f'Bridge {self.host}:{self.port}: {e}') from e
+        except BaseException as e:
+            ## e.g. a request that does not encode. Says nothing about the
+            ## link, but a probe that did not get a response failed.
+            self.__probe_failed(channel, e)
+            raise
+        ## left to the caller, which knows whether a miss is expected
+        if isinstance(result, ModbusIOException):
+            return result
+        self.record_success(channel)
+        return result
+
+    def metrics(self):
+        with self.lock:
+            res = {
+                'bridge': f'{self.host}:{self.port}',
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'outages': self.stats['outages'],
+                'outage_seconds': round(self.stats['outage_seconds'], 1),
+                'current_outage': None,
+                'rejected': self.stats['rejected'],
+                'failures': self.stats['failures'],
+                'last_error': self.stats['last_error'],
+                'channels': {k: dict(v) for k, v in self.stats['channels'].items()},
+            }
+            if self.outage_started is not None:
+                res['current_outage'] = round(time.monotonic() - self.outage_started, 1)
+        return res
@@ -4,6 +4,7 @@ import time
 import random
 import hexdump
 import socket
+import select
 from enum import Enum
 from pymodbus.constants import Endian
 from pymodbus.payload import BinaryPayloadDecoder
@@ -13,9 +14,14 @@ from pymodbus.pdu import ModbusRequest
 from pymodbus.pdu import ModbusResponse
 from pymodbus.transaction import ModbusRtuFramer
 from pymodbus.factory import ClientDecoder
-from threading import Lock
 import logging
 import crcmod
+import yaml
+from .tagolink import BridgeLink, BridgeUnavailable, LINK_ERRORS
+from .tagotiming import BusTiming
+from .tagotrack import ActionTracker
+from .tagodiag import TracedLock
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 
 crc16 = None
 def calc_modbuscrc(data):
@@ -26,12 +32,40 @@ def calc_modbuscrc(data):
     return crc16(data)
 
 
+## site configuration: a list of devices, each with the events to store
+## in its event table
+##
+##   devices:
+##     - device_id: ...
+##       modbus_address: '0x10'
+##       events:
+##         - {address: '0x21', key: 3, duration: 0, action_code: 0,
+##            channel: 1, value: 255, rate: 100}
+class Config(object):
+    def __init__(self, source):
+        if isinstance(source, (dict, list)):
+            data = source
+        else:
+            with open(source) as f:
+                data = yaml.safe_load(f)
+        devices = data.get('devices', []) if isinstance(data, dict) else data
+        self.devices = {str(d['device_id']).strip(): d for d in devices}
+
+    def getDeviceConfigById(self, devid):
+        if devid not in self.devices:
+            raise Exception(f'No configuration for {devid}')
+        return self.devices[devid]
+
+
 class TagoEvents(object):
-    def __init__(self, host, port, stop_event):
+    def __init__(self, host, port, stop_event, link=None):
         self.sock = None
         self.host = host
         self.port = port
         self.stop_event = stop_event
+        self.link = link or BridgeLink(host, port)
+        self.backoff = self.link.backoff()
+        self.recorder = None
 
     def disconnect(self):
         if self.sock:
@@ -44,80 +78,93 @@ class TagoEvents(object):
             return
 
         logging.info(f'Connecting to {self.host}:{self.port} for events')
-        self.sock= socket.create_connection((self.host, self.port))
+        self.sock = socket.create_connection((self.host, self.port),
+                                             timeout=self.link.settings.connect_timeout)
         self.sock.settimeout(120)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        try:
-            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 5)
-            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
-            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
-        except:
-            pass
-
-        try:
-            self.sock.setsockopt(socket.IPPROTO_TCP, TCP_KEEPALIVE, 5)
-        except:
-            pass
-
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.link.settings.apply_keepalive(self.sock)
+        self.link.record_connect('events')
+        self.backoff.reset()
 
         logging.info(f'Connected to {self.host}:{self.port}')
 
-    def getNext(self):
-        try:
-            def modbus_get_next():
-                try:
-                    data = self.sock.recv(6)
-                except socket.timeout:
-                    self.disconnect()
+    ## turn one frame from the bridge (without the MBAP header) into events
+    @staticmethod
+    def parseFrame(data, now=None):
+        (addr, fc, mei_code) = struct.unpack('<BBB', data[0:3])
+        data = data[3:]
+
+        if now is None:
+            now = int(time.time() * 1000)
+
+        result = []
+        ## tagonet message
+        if fc == 43 and mei_code == 43:
+            if data[0] == ord('L'):
+                swaddr, key, duration = struct.unpack('BBB', data[1:4])
+                result.append({'event': 'keypress', 
+                               'ts': now,
+                               'keypad': swaddr, 
+                               'key': key, 
+                               'duration': duration})
+
+                logging.info('Switch Event from 0x{:2x} => addr: 0x{:2x} key: {} duration: {}'.format(addr, swaddr, key, duration))
+                if len(data) > 6:
+                    data = data[5:]
+            if data[0] == ord('D'):
+                ch_count = len(data) - 1
+                dimmer_state = struct.unpack('B' * ch_count, data[1:])
+                state = ''.join(['ch {:d}: {: >3}% '.format(i + 1, int((n * 100 )/ 255)) for i, n in enumerate(dimmer_state)])
+                logging.info('Dimmer Event from 0x{:2x} => '.format(addr) + state)
+
+                state = [{'ch' : i + 1, 'value': int((n * 100 )/ 255)} for i, n in enumerate(dimmer_state)]
+                result.append({'event': 'dimmer_change', 
+                               'ts': now,
+                               'dimmer_addr': addr, 
+                               'state': state})
+        return result
 
-                if len(data) < 6:
-                    return
-
-                length = struct.unpack('>H', data[4:])[0]
-                data = bytes()
-                while len(data) < length:
-                    data += self.sock.recv(length - len(data))
+    def getNext(self):
+        def recv_exact(size):
+            data = bytes()
+            while len(data) < size:
+                chunk = self.sock.recv(size - len(data))
+                if not chunk:
+                    raise ConnectionError('Connection closed by bridge')
+                data += chunk
+            return data
+
+        def modbus_get_next():
+            try:
+                data = recv_exact(6)
+            except socket.timeout:
+                ## idle bus, keepalive will catch a dead bridge
+                return
 
-                return data
+            length = struct.unpack('>H', data[4:])[0]
+            return recv_exact(length)
 
+        try:
             while not self.stop_event.is_set():
-                self.connect()
+                try:
+                    self.connect()
+                    data = modbus_get_next()
+                except LINK_ERRORS as e:
+                    self.disconnect()
+                    self.link.record_failure('events', e)
+                    delay = self.backoff.next()
+                    logging.warning(f'Event link to {self.host}:{self.port} failed ({e}), '
+                                    f'retrying in {delay:.1f}s')
+                    self.stop_event.wait(delay)
+                    continue
 
-                data = modbus_get_next()
                 if data is None:
                     continue
 
-                (addr, fc, mei_code) = struct.unpack('<BBB', data[0:3])
-                data = data[3:]
-
-                now = int(time.time() * 1000)
-
-                result = []
-                ## tagonet message
-                if fc == 43 and mei_code == 43:
-                    if data[0] == ord('L'):
-                        swaddr, key, duration = struct.unpack('BBB', data[1:4])
-                        result.append({'event': 'keypress', 
-                                       'ts': now,
-                                       'keypad': swaddr, 
-                                       'key': key, 
-                                       'duration': duration})
-
-                        logging.info('Switch Event from 0x{:2x} => addr: 0x{:2x} key: {} duration: {}'.format(addr, swaddr, key, duration))
-                        if len(data) > 6:
-                            data = data[5:]
-                    if data[0] == ord('D'):
-                        ch_count = len(data) - 1
-                        dimmer_state = struct.unpack('B' * ch_count, data[1:])
-                        state = ''.join(['ch {:d}: {: >3}% '.format(i + 1, int((n * 100 )/ 255)) for i, n in enumerate(dimmer_state)])
-                        logging.info('Dimmer Event from 0x{:2x} => '.format(addr) + state)
-
-                        state = [].append([{'ch' : i, 'value': int((n * 100 )/ 255)} for i, n in enumerate(dimmer_state)])
-                        result.append({'event': 'dimmer_change', 
-                                       'ts': now,
-                                       'dimmer_addr': addr, 
-                                       'state': state})
+                self.link.record_activity('events')
+                if self.recorder is not None:
+                    self.recorder.write(data)
+
+                result = self.parseFrame(data)
                 if len(result):
                     return result
 
@@ -129,7 +176,6 @@ class TagoEvents(object):
                 self.disconnect()
             except:
                 pass
-            time.sleep(1)
             raise
         
         
@@ -240,19 +286,200 @@ class TagoDevice(object):
             return ModbusResponse()
 
 
-    def __init__(self, host, port, timeout=2):
-        self.lock   = Lock()
+    ## how long a response that missed its timeout is still drained
+    LATE_WINDOW = 0.25
+
+    def __init__(self, host, port, timeout=2, link=None, timing=None):
+        self.lock   = TracedLock('bus')
         self.host   = host
         self.port   = port
+        self.link   = link or BridgeLink(host, port)
+        self.timing = timing or BusTiming(default_timeout=timeout)
+        self.tracker = ActionTracker()
+        ## frames sent without reading their response, and how long to
+        ## wait for those responses at most
+        self.owed = 0
+        self.pending_until = 0
         self.client = ModbusTcpClient(host, port=port, timeout=timeout)
-        self.client.silent_interval = 0.15
         self.client.register(self.TagonetScanResponse)
-        self.client.connect()
+        try:
+            self.link.run('commands', self.__connect, lambda: None)
+        except BridgeUnavailable as e:
+            logging.error(f'Bridge not reachable yet: {e}')
+
+    def __connect(self):
+        if self.client.is_socket_open():
+            return
+        ## connect() uses client.timeout, which holds the request timeout
+        timeout = self.client.timeout
+        self.client.timeout = self.link.settings.connect_timeout
+        try:
+            if not self.client.connect():
+                raise ConnectionException(f'Failed to connect to {self.host}:{self.port}')
+        finally:
+            self.client.timeout = timeout
+        self.link.settings.apply_keepalive(self.client.socket)
+        self.link.record_connect('commands')
+        ## nothing owed on a new connection
+        self.owed = 0
+        self.pending_until = 0
+
+    ## timing is learned per kind of request. Scans and address changes get
+    ## None, they are answered by whichever device is there and always get
+    ## the default timeout.
+    def __kind(self, fn, args):
+        if fn == self.client.execute:
+            if isinstance(args[0], (self.TagonetScanRequest, self.TagonetSetAddressRequest)):
+                return None
+            return type(args[0]).__name__
+        if fn.__name__.startswith('read_'):
+            return f'{fn.__name__}/{args[1]}'
+        return fn.__name__
+
+    ## every bus transaction goes through the bridge link so a dead bridge
+    ## fails fast instead of waiting out the modbus timeout, and is paced
+    ## by the node's calibrated gap and timeout. Misses that are not
+    ## `expected` count towards the link's silent nodes, and their response
+    ## is drained if it turns up late. Callers hold self.lock.
+    def __transact(self, node, adapt, fn, *args, expected=False, **kwargs):
+        kind = self.__kind(fn, args)
+        self.__drain()
+        self.timing.wait_gap(node)
+        timeout = self.timing.timeout(node, kind)
+        self.client.timeout = timeout
+        start = time.monotonic()
+        try:
+            res = self.link.run('commands', self.__connect, fn, *args, **kwargs)
+        except BridgeUnavailable:
+            self.client.close()
+            raise
+        missed = isinstance(res, ModbusIOException)
+        self.timing.observe(node, time.monotonic() - start, not missed, adapt, kind)
+        if not missed:
+            self.link.record_answer(node)
+        else:
+            if self.link.record_silence('commands', node, res, expected=expected or not adapt):
+                self.client.close()
+            else:
+                self.owed += 1
+                self.pending_until = max(self.pending_until,
+                                         time.monotonic() + min(timeout, self.LATE_WINDOW))
+        return res
+
+    def __call(self, node, fn, *args, **kwargs):
+        return self.__transact(node, True, fn, *args, **kwargs)
+
+    ## for requests where no answer is a valid result: presence checks and
+    ## the end of a scan
+    def __probe(self, node, fn, *args, **kwargs):
+        return self.__transact(node, True, fn, *args, expected=True, **kwargs)
+
+    ## send a request without waiting for its response, only the
+    ## inter-frame gap is kept. Callers hold self.lock.
+    def __send(self, node, request):
+        def send():
+            request.transaction_id = self.client.transaction.getNextTID()
+            self.client.send(self.client.framer.buildPacket(request))
+
+        self.timing.wait_gap(node)
+        try:
+            self.link.run('commands', self.__connect, send)
+        except BridgeUnavailable:
+            self.client.close()
+            raise
+        self.timing.sent()
+        self.owed += 1
+        self.pending_until = max(self.pending_until,
+                                 time.monotonic() + self.timing.timeout(node, type(request).__name__))
+
+    ## throw away the responses owed to frames sent by __send, or to
+    ## requests that timed out, so they are not taken for the answer to the
+    ## next request. Whatever is already in the socket is always read, only
+    ## waiting for responses that have not arrived ends when the last one
+    ## is due.
+    def __drain(self):
+        if not self.owed:
+            return
+        data = bytes()
+        try:
+            while self.client.socket is not None:
+                wait = max(0, self.pending_until - time.monotonic()) if self.owed > 0 else 0
+                if not select.select([self.client.socket], [], [], wait)[0]:
+                    break
+                chunk = self.client.socket.recv(1024)
+                if not chunk:
+                    self.client.close()
+                    break
+                data += chunk
+                ## count complete MBAP frames
+                while len(data) >= 6 and len(data) >= 6 + struct.unpack('>H', data[4:6])[0]:
+                    data = data[6 + struct.unpack('>H', data[4:6])[0]:]
+                    self.owed -= 1
+            ## half a frame left in the socket would garble the next response
+            if len(data):
+                self.client.close()
+        except OSError:
+            self.client.close()
+        self.owed = 0
+        self.pending_until = 0
+
+    ## retry a request until the node answers or the deadline passes. Used
+    ## where a node is busy applying a change, misses are expected there.
+    def __poll(self, node, deadline, fn, *args, **kwargs):
+        end = time.monotonic() + deadline
+        while True:
+            res = self.__transact(node, False, fn, *args, **kwargs)
+            if not isinstance(res, ModbusIOException) or time.monotonic() >= end:
+                return res
+
+    ## measure round trip times and find the smallest inter-frame gap each
+    ## node copes with. Results are kept by self.timing. The gap is walked
+    ## down until frames get lost, so this only runs when asked for. The
+    ## lock is taken per request so normal traffic can get in between.
+    def calibrateTiming(self, nodes, samples=20, probes=10):
+        def sample(node):
+            try:
+                self.lock.acquire()
+                res = self.__transact(node, False, self.client.read_holding_registers, 0x400, 2, unit=node)
+            finally:
+                self.lock.release()
+            return not isinstance(res, ModbusIOException)
+
+        gaps = (0.08, 0.04, 0.02, 0.01, 0.005, 0)
+        for node in nodes:
+            answered = sum(sample(node) for i in range(samples))
+            if answered < samples / 2:
+                logging.error('Node 0x{:02x} answered {} of {} requests, not calibrated'.format(node, answered, samples))
+                continue
+
+            previous = self.timing.calibrated_gap(node)
+            best = None
+            try:
+                for gap in gaps:
+                    self.timing.set_gap(node, gap)
+                    if not all(sample(node) for i in range(probes)):
+                        break
+                    best = gap
+            finally:
+                ## never leave a probing gap behind
+                self.timing.set_gap(node, previous)
+
+            if best is None:
+                logging.error('Node 0x{:02x} missed requests at every gap, not calibrated'.format(node))
+                continue
+
+            ## keep some margin over the smallest gap that worked
+            gap = min(self.timing.MAX_GAP, best * 1.25)
+            self.timing.set_gap(node, gap)
+            logging.info('Node 0x{:02x}: gap {:.1f}ms'.format(node, gap * 1000))
+
+        self.timing.save()
+        return self.timing.stats()
 
     def getInfo(self, node):
         try:
             self.lock.acquire()
-            res = self.client.read_holding_registers(0x400, 24, unit=node)
+            res = self.__call(node, self.client.read_holding_registers, 0x400, 24, unit=node)
         finally:
             self.lock.release()
         
@@ -275,70 +502,163 @@ class TagoDevice(object):
             'uptime': uptime,
         }
 
+    ## model code from register 0x400, formatted like getInfo(). Returns
+    ## None if the node does not answer.
+    def readModel(self, node):
+        try:
+            self.lock.acquire()
+            res = self.__probe(node, self.client.read_holding_registers, 0x400, 1, unit=node)
+        finally:
+            self.lock.release()
+
+        if res.isError():
+            return None
+        return '{:04X}'.format(res.registers[0])
+
+    ## cheap presence check, reads only the device id block. Returns None
+    ## if the node does not answer.
+    def readDeviceId(self, node):
+        try:
+            self.lock.acquire()
+            res = self.__probe(node, self.client.read_holding_registers, 0x408, 16, unit=node)
+        finally:
+            self.lock.release()
+
+        if res.isError():
+            return None
+        decoder = BinaryPayloadDecoder.fromRegisters(res.registers, byteorder='>')
+        return decoder.decode_string(32).decode('utf-8', 'ignore').replace('\u0000', '').strip()
+
     def reboot(self, node, wait=1):
         try:
             self.lock.acquire()
-            self.client.write_register(0x511, wait, unit=node)
+            self.__call(node, self.client.write_register, 0x511, wait, unit=node)
         finally:
             self.lock.release()
 
     def identify(self, node, duration=5):
         try:
             self.lock.acquire()
-            self.client.write_register(0x510, duration * 8, unit=node)
+            self.__call(node, self.client.write_register, 0x510, duration * 8, unit=node)
+        finally:
+            self.lock.release()
+
+    ## The event table holds one 4 register record every 8 registers from
+    ## 0x1000 and ends with an all zero record. 0x402 holds the CRC of the
+    ## table as its version.
+    CONFIG_TABLE       = 0x1000
+    CONFIG_STRIDE      = 8
+    CONFIG_MAX_RECORDS = 128
+    ## pause after each background write so foreground requests get the bus
+    BACKGROUND_YIELD   = 0.005
+
+    @staticmethod
+    def buildConfigImage(config):
+        def num(v):
+            return int(v, 0) if isinstance(v, str) else int(v)
+
+        regs = list()
+        for n in config['events']:
+            action = n['action_code'] if 'action_code' in n else TagoDevice.Actions[n['action'].upper()].value
+            fields = [num(n['address']), num(n['key']), num(n['duration']), num(action),
+                      num(n['channel']), num(n['value']), num(n['rate'])]
+            if not all(0 <= f <= 0xFF for f in fields):
+                raise ValueError(f'Event field out of range: {n}')
+            TagoDevice.Actions(fields[3])
+            regs.append([(1 << 8) | fields[0],
+                        (fields[1] << 8) | fields[2],
+                        (fields[3] << 8) | fields[4],
+                        (fields[5] << 8) | fields[6]])
+
+        if len(regs) >= TagoDevice.CONFIG_MAX_RECORDS:
+            raise ValueError(f'{len(regs)} events do not fit the event table')
+        regs.append([0, 0, 0, 0])
+
+        cksum = calc_modbuscrc(bytes([x for sl in regs for item in sl for x in [item >> 8, item & 0xFF]]))
+        return regs, cksum
+
+    def readConfigVersion(self, node):
+        try:
+            self.lock.acquire()
+            res = self.__call(node, self.client.read_holding_registers, 0x402, 1, unit=node)
         finally:
             self.lock.release()
 
+        decoder = BinaryPayloadDecoder.fromRegisters(res.registers, byteorder='>')
+        return decoder.decode_16bit_uint()
+
+    ## read the event table up to and including the terminating record
+    def readConfigImage(self, node, background=False):
+        per_read = 120 // self.CONFIG_STRIDE
+        regs = list()
+        offset = self.CONFIG_TABLE
+        while len(regs) < self.CONFIG_MAX_RECORDS:
+            try:
+                self.lock.acquire()
+                res = self.__call(node, self.client.read_holding_registers, offset,
+                                  per_read * self.CONFIG_STRIDE, unit=node)
+            finally:
+                self.lock.release()
+            if res.isError():
+                raise Exception(f'Reading event table of 0x{node:02x} failed: {res}')
+            if background:
+                time.sleep(self.BACKGROUND_YIELD)
+
+            for i in range(per_read):
+                record = res.registers[i * self.CONFIG_STRIDE:i * self.CONFIG_STRIDE + 4]
+                regs.append(record)
+                if not any(record):
+                    return regs
+            offset += per_read * self.CONFIG_STRIDE
+
+        return regs
+
+    ## write an event table and its version. With background=True the lock
+    ## is taken per record so other requests can interleave.
+    def writeConfigImage(self, node, regs, version, background=False):
+        def write(fn, *args):
+            try:
+                self.lock.acquire()
+                res = self.__call(node, fn, *args, unit=node)
+            finally:
+                self.lock.release()
+            if res.isError():
+                raise Exception(f'Write to 0x{node:02x} failed: {res}')
+            if background:
+                time.sleep(self.BACKGROUND_YIELD)
+
+        offset = self.CONFIG_TABLE
+        for r in regs:
+            write(self.client.write_registers, offset, r)
+            offset += self.CONFIG_STRIDE
+
+        write(self.client.write_register, 0x402, version)
+
     def updateConfiguration(self, configfile, devid):
         cfg = Config(configfile)
 
         def updateDeviceConfig(cfg, devid):
             config = cfg.getDeviceConfigById(devid)
-
-            regs = list()
-            for n in config['events']:
-                regs.append([(1 << 8) | int(n['address'], 0), 
-                            (int(n['key']) << 8) | int(n['duration']),
-                            (int(n['action_code']) << 8) | int(n['channel']),
-                            (int(n['value']) << 8) | int(n['rate'])])
-
-            regs.append([0, 0, 0, 0])
-
-            cksum = calc_modbuscrc(bytes([x for sl in regs for item in sl for x in [item >> 8, item & 0xFF]]))
+            regs, cksum = self.buildConfigImage(config)
 
             node = int(config['modbus_address'], 0)
             logging.info('Updating config for {} at 0x{:2x}'.format(devid, node))
 
             ## get current version
-            res = self.client.read_holding_registers(0x402, 1, unit=node)
-            decoder = BinaryPayloadDecoder.fromRegisters(res.registers, byteorder='>')
-            version = decoder.decode_16bit_uint();
-
+            version = self.readConfigVersion(node)
             if version == cksum:
                 logging.info('Device config has not changed ({:2x})'.format(version))
                 return
-            else:
-                version = cksum
 
-            offset = 0x1000
-            for r in regs:
-                self.client.write_registers(offset, r, unit=node)
-                offset += 8
+            self.writeConfigImage(node, regs, cksum)
+            logging.info('Wrote config {:2x}.'.format(cksum))
 
-            self.client.write_registers(0x402, version, unit=node)
-            logging.info('Wrote config {:2x}.'.format(version))
-
-        try:
-            self.lock.acquire()
-
-            if len(devid):
-                updateDeviceConfig(cfg, devid)
-            else:
-                devices = self.scanBus(0)
-                for d in devices:
-                    updateDeviceConfig(cfg, d['device'].strip())
-        finally:
-            self.lock.release()
+        if len(devid):
+            updateDeviceConfig(cfg, devid)
+        else:
+            devices = self.scanBus(0)
+            for d in devices:
+                updateDeviceConfig(cfg, d['device_id'].strip())
 
 
     def scanBus(self, node):
@@ -348,13 +668,12 @@ class TagoDevice(object):
         try:
             self.lock.acquire()
             while True:
-                resp = self.client.execute(self.TagonetScanRequest(unit=node, reqid=reqid))
+                resp = self.__probe(node, self.client.execute, self.TagonetScanRequest(unit=node, reqid=reqid))
                 if not isinstance(resp, TagoDevice.TagonetScanResponse):
                     logging.info('No device found')
                     return found
                 logging.info('Found device {} at address 0x{:2x}'.format(resp.targetid, resp.address))
                 found.append({'device_id': resp.targetid, 'addr': resp.address})
-                time.sleep(0.2)
         finally:
             self.lock.release()
 
@@ -362,9 +681,11 @@ class TagoDevice(object):
         logging.info('Assigning address on {} to {}'.format(targetid, address))
         try:
             self.lock.acquire()
-            resp = self.client.execute(self.TagonetSetAddressRequest(address=address, targetid=targetid, unit=node))
-            time.sleep(0.5)
-            resp = self.client.read_holding_registers(0x400, 2, unit=address)
+            resp = self.__call(node, self.client.execute, self.TagonetSetAddressRequest(address=address, targetid=targetid, unit=node))
+            ## the device answers on the new address once it has applied it
+            resp = self.__poll(address, 1, self.client.read_holding_registers, 0x400, 2, unit=address)
+            if isinstance(resp, ModbusIOException):
+                raise Exception(f'{targetid} does not answer on {address}')
             logging.info('Changed address on {} to {}'.format(targetid, address))
             return True
         except Exception as e:
@@ -373,28 +694,40 @@ class TagoDevice(object):
         finally:
             self.lock.release()
 
-    def emulateKeypress(self, node, addr, key, duration):
+    ## with wait=False the frame is sent without waiting for the response.
+    ## The nodes a keypress drives come from the event tables, so it is not
+    ## tracked.
+    def emulateKeypress(self, node, addr, key, duration, wait=True):
+        request = self.TagonetLegacyKeypressRequest(addr, key, duration, unit=node)
         try:
             self.lock.acquire()
-            self.client.execute(self.TagonetLegacyKeypressRequest(addr, key, duration, unit=node))
+            if wait:
+                self.__call(node, self.client.execute, request)
+            else:
+                self.__send(node, request)
         finally:
             self.lock.release()
 
-    def directAction(self, node, channel, action, value, rate=100):
+    def directAction(self, node, channel, action, value, rate=100, wait=True):
+        request = self.TagonetDirectActionRequest(channel, action, value, rate, unit=node)
         try:
             self.lock.acquire()
-            self.client.execute(self.TagonetDirectActionRequest(channel, action, value, rate, unit=node))
+            if wait:
+                self.__call(node, self.client.execute, request)
+            else:
+                self.__send(node, request)
+                self.tracker.expect(node, channel=channel, action=action, value=value)
         finally:
             self.lock.release()
 
     ## The entire firmware has to be written in one pass and must be done in 
     ## increasing sequential address order. Firmware chunks offsets 
     ## must be aligned to 32-bit boundary.
-    def updateFirmware(self, node, file):
+    def updateFirmware(self, node, file, send_size=64):
         def writeRecord(node, fn, rn, rd):
             try:
                 self.lock.acquire()
-                self.client.execute(WriteFileRecordRequest([FileRecord(file_number=fn,
+                self.__call(node, self.client.execute, WriteFileRecordRequest([FileRecord(file_number=fn,
                                                                     record_number=rn, 
                                                                     record_data=rd)], 
                                                                     unit=node))
@@ -410,7 +743,6 @@ class TagoDevice(object):
         if len(data) % 4:
             data += bytes('\0'.encode('utf-8') * (4 - (len(data) % 4)))
         crc = calc_modbuscrc(data)
-        send_size = 64
         offset = 0
 
         logging.info('Firmware {} bytes. CRC: {:04X}'.format(len(data), crc))
@@ -422,7 +754,7 @@ class TagoDevice(object):
         while offset < len(data):
             wrsize = min(send_size, len(data) - offset)
             chunk = bytes(data[offset : offset + wrsize])
-            logging.info('\rSending bytes {} to {} of {} ({}%)'.format(offset, offset + wrsize, len(data), round(offset * 100 / len(data), 1) ), end='\r')
+            logging.info('Sending bytes {} to {} of {} ({}%)'.format(offset, offset + wrsize, len(data), round(offset * 100 / len(data), 1) ))
             # hexdump.hexdump(chunk)
 
             writeRecord(node=node, fn=0xFFFF, rn=record, rd=chunk)
@@ -432,11 +764,11 @@ class TagoDevice(object):
 
         ## send end of chunks
         writeRecord(node=node, fn=0xFFFF, rn=9999, rd=struct.pack('>H', crc))
-        time.sleep(0.1)
 
-        logging.info('')
         try:
-            res = self.client.read_holding_registers(0x800, 1, unit=node)
+            self.lock.acquire()
+            ## the node checks the image before it answers again
+            res = self.__poll(node, 1, self.client.read_holding_registers, 0x800, 1, unit=node)
             decoder = BinaryPayloadDecoder.fromRegisters(res.registers, byteorder='>')
             calc_crc = decoder.decode_16bit_uint();
             if calc_crc != crc:
@@ -444,9 +776,11 @@ class TagoDevice(object):
                 return False
 
             ## write CRC to firmware register to boot to new firmware
-            self.client.write_register(0x800, crc, unit=node)
+            self.__call(node, self.client.write_register, 0x800, crc, unit=node)
+            ## give the node time to reboot into the new image, this is boot
+            ## time rather than bus timing
             time.sleep(1)
-            res = self.client.read_holding_registers(0x800, 1, unit=node)
+            res = self.__poll(node, 2, self.client.read_holding_registers, 0x800, 1, unit=node)
             decoder = BinaryPayloadDecoder.fromRegisters(res.registers, byteorder='>')
             calc_crc = decoder.decode_16bit_uint();
             if calc_crc == 0:
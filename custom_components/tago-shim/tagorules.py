@@ -0,0 +1,242 @@
+from .tagonet import TagoDevice
+import os
+import time
+import queue
+import logging
+import threading
+import yaml
+
+## matches any press duration
+ANY_DURATION = None
+
+
+class RuleError(Exception):
+    pass
+
+
+class RuleEngine(object):
+    """Runs keypress bindings inside the shim.
+
+    Rules come from a YAML file (a list under `rules:`) and from the `rules`
+    table of the device registry. Each rule looks like the entries of a
+    device event table:
+
+        - name: hall lights
+          keypad: 0x21        # address of the keypad sending the 'L' event
+          key: 3
+          duration: 0         # optional, omit to match any press
+          device: <device_id> # or `addr: 0x10` for a raw modbus address
+          channel: 1
+          action: toggle      # or action_code: 0
+          value: 100          # percent, like /api/<tid>/do
+          rate: 100
+
+    Rules are compiled into a dict keyed by (keypad, key, duration) so a
+    keypress costs at most two lookups. Matching actions are queued to a
+    worker thread that sends them without waiting for the response, so the
+    event thread never waits on the bus.
+    """
+    RELOAD_CHECK_INTERVAL = 1
+    QUEUE_SIZE = 1000
+
+    def __init__(self, net, devices, table=None, path=None, validate=None):
+        self.net = net
+        self.devices = devices
+        self.validate = validate
+        self.table = table
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.rules = {}
+        self.stats = {}
+        self.errors = []
+        self.mtime = None
+        self.last_check = 0
+        self.actions = queue.Queue(self.QUEUE_SIZE)
+        self.worker = None
+        self.reload()
+
+    def __load_file(self):
+        if not self.path or not os.path.exists(self.path):
+            self.mtime = None
+            return []
+
+        self.mtime = os.stat(self.path).st_mtime
+        with open(self.path) as f:
+            data = yaml.safe_load(f) or {}
+        if isinstance(data, dict):
+            data = data.get('rules') or []
+        if not isinstance(data, list):
+            raise RuleError(f'{self.path}: expected a list of rules')
+        return data
+
+    def __load_table(self):
+        if self.table is None:
+            return []
+        return [dict(self.table[k], name=self.table[k].get('name', k)) for k in self.table.keys()]
+
+    def __resolve_addr(self, rule):
+        if 'addr' in rule:
+            return int(rule['addr'], 0) if isinstance(rule['addr'], str) else int(rule['addr'])
+        device = rule.get('device')
+        if device not in self.devices:
+            raise RuleError(f'device {device} not found')
+        return self.devices[device]['addr']
+
+    def __compile(self, rule):
+        def num(v):
+            return int(v, 0) if isinstance(v, str) else int(v)
+
+        if 'action_code' in rule:
+            action = TagoDevice.Actions(num(rule['action_code']))
+        else:
+            action = TagoDevice.Actions[str(rule.get('action', '')).upper()]
+
+        ## check against the device's capabilities when we know which one it is
+        if self.validate is not None and 'device' in rule:
+            self.validate(rule['device'], num(rule['channel']), action.name)
+
+        duration = rule.get('duration', ANY_DURATION)
+        value = min(max(num(rule.get('value', 0)), 0), 100)
+        return {
+            'key': (num(rule.get('keypad', rule.get('address'))),
+                    num(rule['key']),
+                    ANY_DURATION if duration is None else num(duration)),
+            'node': self.__resolve_addr(rule),
+            'channel': num(rule['channel']),
+            'action': action.value,
+            'value': int((value * 255) / 100),
+            'rate': num(rule.get('rate', 100)),
+        }
+
+    ## rebuild the index from the YAML file and the registry table. Bad rules
+    ## are logged and skipped, the rest stay active.
+    def reload(self):
+        index = {}
+        rules = {}
+        errors = []
+
+        try:
+            sources = self.__load_file()
+        except Exception as e:
+            logging.error(f'Could not load rules from {self.path}: {e}')
+            errors.append({'rule': self.path, 'error': str(e)})
+            sources = []
+        sources += self.__load_table()
+
+        for n, rule in enumerate(sources):
+            name = str(rule.get('name', f'rule-{n}'))
+            try:
+                compiled = self.__compile(rule)
+            except Exception as e:
+                logging.error(f'Rule {name} ignored: {e!r}')
+                errors.append({'rule': name, 'error': repr(e)})
+                continue
+            compiled['name'] = name
+            index.setdefault(compiled['key'], []).append(compiled)
+            rules[name] = rule
+
+        with self.lock:
+            self.index = index
+            self.rules = rules
+            self.errors = errors
+            self.stats = {k: v for k, v in self.stats.items() if k in rules}
+
+        logging.info(f'Loaded {len(rules)} keypress rules ({len(errors)} errors)')
+
+    def __check_reload(self):
+        now = time.monotonic()
+        if now - self.last_check < self.RELOAD_CHECK_INTERVAL:
+            return
+        self.last_check = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime if self.path else None
+        except OSError:
+            mtime = None
+        if mtime != self.mtime:
+            self.reload()
+
+    def __record(self, name, latency, error=None):
+        with self.lock:
+            s = self.stats.setdefault(name, {'count': 0, 'errors': 0, 'last_ms': 0,
+                                             'avg_ms': 0, 'max_ms': 0, 'last_ts': None})
+            s['count'] += 1
+            if error is not None:
+                s['errors'] += 1
+                s['last_error'] = str(error)
+            s['last_ms'] = latency
+            s['avg_ms'] = round(s['avg_ms'] + (latency - s['avg_ms']) / s['count'], 1)
+            s['max_ms'] = max(s['max_ms'], latency)
+            s['last_ts'] = round(time.time())
+
+    def __run_actions(self):
+        while True:
+            rule, ts = self.actions.get()
+            error = None
+            try:
+                self.net.directAction(rule['node'], rule['channel'], rule['action'],
+                                      rule['value'], rule['rate'], wait=False)
+            except Exception as e:
+                logging.error(f'Rule {rule["name"]} failed: {e}')
+                error = e
+            ## latency is measured from when the frame was parsed
+            self.__record(rule['name'], int(time.time() * 1000) - ts, error)
+            self.actions.task_done()
+
+    ## called from the event thread with a parsed 'keypress' event. Returns
+    ## the number of rules that fired.
+    def dispatch(self, event):
+        self.__check_reload()
+
+        key = (event['keypad'], event['key'])
+        index = self.index
+        matches = index.get(key + (event['duration'],), []) + index.get(key + (ANY_DURATION,), [])
+        if not len(matches):
+            return 0
+
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(name='Rule Actions', target=self.__run_actions, daemon=True)
+                self.worker.start()
+
+        for rule in matches:
+            try:
+                self.actions.put_nowait((rule, event['ts']))
+            except queue.Full:
+                logging.error(f'Rule {rule["name"]} dropped, action queue is full')
+                self.__record(rule['name'], 0, 'action queue is full')
+
+        return len(matches)
+
+    ## wait until every queued action was sent
+    def join(self):
+        self.actions.join()
+
+    ## the same rules on another net, e.g. one that sends nothing
+    def with_net(self, net):
+        return RuleEngine(net, self.devices, table=self.table, path=self.path, validate=self.validate)
+
+    def add_rule(self, name, rule):
+        if self.table is None:
+            raise RuleError('No rule table configured')
+        try:
+            self.__compile(rule)
+        except RuleError:
+            raise
+        except Exception as e:
+            raise RuleError(f'Invalid rule {name}: {e!r}') from e
+        self.table[name] = rule
+        self.reload()
+
+    def remove_rule(self, name):
+        if self.table is not None and name in self.table:
+            del self.table[name]
+        self.reload()
+
+    def list_rules(self):
+        with self.lock:
+            return {
+                'rules': {k: dict(v, stats=self.stats.get(k)) for k, v in self.rules.items()},
+                'errors': list(self.errors),
+            }
@@ -5,19 +5,30 @@ import time
 import json
 from .tagoapi import TagoApi
 from .tagonet import TagoEvents
+from .tagolink import BridgeLink, LinkSettings
+from .tagocaps import CapabilityError
+from .tagorules import RuleError
+from .tagodiag import Diagnostics
+from .tagocapture import CaptureWriter, Replay
+from .tagocache import ResponseCache
 from SimpleWebSocketServer import WebSocket, SimpleWebSocketServer
 import uuid
 import logging
 import threading
 import os
 
-class TagoEventServer(SimpleWebSocketServer):
-    clients = set()
+## encode once, send to every client
+def fanout(clients, result):
+    msg = json.dumps(result)
+    for c in clients.copy():
+        c.sendMessage(msg)
+
 
+class TagoEventServer(SimpleWebSocketServer):
     class EventHandler (WebSocket):
         def __init__(self, server, sock, address):
             super().__init__(server, sock, address)
-            self.clients = TagoEventServer.clients
+            self.clients = server.clients
 
         def handleMessage(self):
             pass
@@ -30,25 +41,60 @@ class TagoEventServer(SimpleWebSocketServer):
             self.clients.remove(self)
             logging.info('closed {}'.format(self.address))
 
-    def __init__(self, host, port, linkHost, linkPort, stop_event):
+    def __init__(self, host, port, linkHost, linkPort, stop_event, link=None, capture=None):
         super().__init__(host, port, TagoEventServer.EventHandler)
+        self.clients = set()
         self.host = host
         self.port = port
+        self.linkHost = linkHost
+        self.linkPort = linkPort
         self.stop_event = stop_event
-        self.thread = threading.Thread(target=self.event_worker, args=(linkHost, linkPort)).start()
+        self.link = link
+        self.rules = None
+        self.tracker = None
+        self.state = None
+        self.capture = capture
+        self.events = None
 
     def serve(self):
         logging.info('Running websocket server on {}:{}'.format(self.host, self.port))
-        threading.Thread(target=self.serveforever).start()    
+        threading.Thread(name='WebSocket Server', target=self.serveforever).start()    
+        threading.Thread(name='Event Worker', target=self.event_worker, args=(self.linkHost, self.linkPort)).start()
+
+    def broadcast(self, result):
+        fanout(self.clients, result)
+
+    ## actions sent without waiting that no 'D' event confirmed in time
+    def report_unconfirmed(self, actions):
+        self.broadcast([dict(a, event='action_unconfirmed') for a in actions])
+
+    ## everything the event worker does with the events of one frame, also
+    ## driven by tagocapture.Replay
+    def handle(self, result):
+        ## local bindings run before anything goes out to clients
+        for e in result:
+            if e['event'] == 'keypress':
+                if self.rules is not None:
+                    self.rules.dispatch(e)
+                if self.state is not None:
+                    self.state.seen(e['keypad'], e['ts'])
+            elif e['event'] == 'dimmer_change':
+                if self.tracker is not None:
+                    self.tracker.confirm(e['dimmer_addr'], e['state'])
+                if self.state is not None:
+                    self.state.update_levels(e['dimmer_addr'], e['state'], e['ts'])
+        self.broadcast(result)
 
     def event_worker(self, host, port):
-        self.events = TagoEvents(host, port, self.stop_event)
+        self.events = TagoEvents(host, port, self.stop_event, link=self.link)
+        self.events.recorder = self.capture
+        ## getNext blocks until the bridge sends something
         while not self.stop_event.is_set():
-            time.sleep(0.05)
             try:
                 result = self.events.getNext()
-                for c in TagoEventServer.clients.copy():
-                    c.sendMessage(json.dumps(result))
+                if result is None:
+                    continue
+                self.handle(result)
             except Exception as e:
                 logging.error('event_worker Exception: {}'.format(e))
                 time.sleep(1)
@@ -58,24 +104,48 @@ class TagoEventServer(SimpleWebSocketServer):
 ##
 ## REST API
 ##
-def flask_thread(tagoapi, port):
+def flask_thread(tagoapi, port, diagnostics=None):
     app = Flask(__name__)
 
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+    ## identical reads that arrive together share one TagoApi call, repeats
+    ## are answered from the cache, or with 304 when the ETag matches
+    cache = ResponseCache()
+    LIST_TTL = 60
+    INFO_TTL = 5
+
+    def cached(key, ttl, compute):
+        value, etag = cache.get(key, ttl, compute)
+        response = jsonify(value)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    ## changes made outside a request: models read from devices and
+    ## finished deployments
+    def changed(tid):
+        if tid is None:
+            cache.invalidate()
+        else:
+            cache.invalidate('list_devices', f'info/{tid}')
+    tagoapi.on_change = changed
+
     @app.route("/api/<tid>/rename_device", methods=['POST', 'GET'])
     def rename(tid):
         tagoapi.rename_device(tid, request.json['name'])
+        cache.invalidate('list_devices')
         return {'status': 'ok'}
         
     @app.route("/api/<tid>/rename_channel", methods=['POST', 'GET'])
     def rename_channel(tid):
         tagoapi.rename_channel(tid, request.json['ch'], request.json['name'])
+        cache.invalidate('list_devices')
         return {'status': 'ok'}
 
     @app.route("/api/<tid>/info")
     def info(tid):
-        return tagoapi.device_info(tid)
+        return cached(f'info/{tid}', INFO_TTL, lambda: tagoapi.device_info(tid))
 
     @app.route("/api/<tid>/identify")
     def identify(tid):
@@ -85,11 +155,16 @@ def flask_thread(tagoapi, port):
     @app.route("/api/<tid>/reboot")
     def reboot(tid):
         tagoapi.reboot_device(tid)
+        cache.invalidate(f'info/{tid}')
         return {'status': 'ok'}
 
     @app.route("/api/<tid>/do", methods=['POST', 'GET'])
     def take_action(tid):
         commands = request.json
+        ## with ?nowait=1 frames are not acknowledged by the bus, the 'D'
+        ## event confirms them and /api/action_status reports misses
+        wait = request.args.get('nowait') != '1'
+        rejected = []
         for item in commands:
             # logging.info(item)
             channel = item.get('ch', 0)
@@ -99,19 +174,198 @@ def flask_thread(tagoapi, port):
             value = item.get('value', 0)
             rate = item.get('rate', 100)
 
-            tagoapi.device_action(tid, channel, action, value, rate)
-                                 
+            ## commands the device cannot carry out never reach the bus
+            try:
+                tagoapi.device_action(tid, channel, action, value, rate, wait=wait)
+            except CapabilityError as e:
+                rejected.append({'ch': channel, 'action': action, 'error': str(e)})
+        cache.invalidate(f'info/{tid}')
+
+        if len(rejected):
+            return {'status': 'error', 'rejected': rejected}, 400
+        return {'status': 'ok'}
+
+    ## last known state, served from the snapshot without touching the bus
+    @app.route("/api/<tid>/state")
+    def state(tid):
+        return tagoapi.device_state(tid)
+
+    @app.route("/api/states")
+    def states():
+        return tagoapi.device_states()
+
+    @app.route("/api/<tid>/capabilities")
+    def capabilities(tid):
+        return tagoapi.device_capabilities(tid)
+
+    ## model code to capabilities mapping
+    @app.route("/api/models")
+    def models():
+        return tagoapi.list_models()
+
+    @app.route("/api/set_model", methods=['POST'])
+    def set_model():
+        try:
+            tagoapi.set_model(request.json['model'], request.json['capabilities'])
+        except (CapabilityError, KeyError, TypeError) as e:
+            return {'status': 'error', 'error': str(e)}, 400
+        cache.invalidate()
         return {'status': 'ok'}
 
     ## rescan all devices on the bus
     @app.route("/api/rescan_all")
     def rescan_all():
-        return tagoapi.rescan_bus()
+        try:
+            return tagoapi.rescan_bus(prune=request.args.get('prune') == '1')
+        finally:
+            cache.invalidate()
+
+    ## check known devices, enumerate only unassigned ones
+    @app.route("/api/rescan")
+    def rescan():
+        try:
+            return tagoapi.rescan_bus(incremental=True,
+                                      prune=request.args.get('prune') == '1')
+        finally:
+            cache.invalidate()
+
+    ## push a whole-site config ({'devices': [...]}, same layout as the
+    ## config file) in the background. Progress is streamed to WebSocket
+    ## clients as 'deploy_progress' events.
+    @app.route("/api/deploy", methods=['POST'])
+    def deploy():
+        try:
+            deployment = tagoapi.deploy_config(request.json)
+            return {'status': 'ok', 'deployment': deployment}
+        except Exception as e:
+            return {'status': 'error', 'error': str(e)}, 400
+
+    @app.route("/api/deploy_status")
+    def deploy_status():
+        return tagoapi.deploy_status()
+
+    ## measured bus timing per node
+    @app.route("/api/bus_timing")
+    def bus_timing():
+        return tagoapi.bus_timing()
+
+    @app.route("/api/calibrate", methods=['POST', 'GET'])
+    def calibrate():
+        ## ?new=1 skips devices that already have a gap
+        return tagoapi.calibrate_bus(force=request.args.get('new') != '1')
+
+    ## confirmation stats for actions sent without waiting
+    @app.route("/api/action_status")
+    def action_status():
+        return tagoapi.action_status()
+
+    ## connection health and outage counters for the bridge
+    @app.route("/api/bridge_status")
+    def bridge_status():
+        return tagoapi.bridge_status()
+
+    ## hits, misses and coalesced requests of the response cache
+    @app.route("/api/cache_status")
+    def cache_status():
+        return cache.status()
+
+    ## keypress rules handled inside the shim
+    @app.route("/api/rules")
+    def list_rules():
+        return tagoapi.rules.list_rules()
+
+    @app.route("/api/reload_rules", methods=['POST', 'GET'])
+    def reload_rules():
+        tagoapi.rules.reload()
+        return tagoapi.rules.list_rules()
+
+    @app.route("/api/add_rule", methods=['POST'])
+    def add_rule():
+        try:
+            tagoapi.rules.add_rule(request.json['name'], request.json['rule'])
+        except (RuleError, KeyError, TypeError) as e:
+            return {'status': 'error', 'error': str(e)}, 400
+        return {'status': 'ok'}
+
+    @app.route("/api/remove_rule", methods=['POST'])
+    def remove_rule():
+        tagoapi.rules.remove_rule(request.json['name'])
+        return {'status': 'ok'}
 
     ## list all devices
     @app.route("/api/list_devices")
     def list():
-        return tagoapi.list_devices()
+        return cached('list_devices', LIST_TTL, tagoapi.list_devices)
+
+    ## opt-in diagnostics, only there when DIAGNOSTICS=1
+    if diagnostics is not None:
+        @app.route("/api/admin/profile/start", methods=['POST', 'GET'])
+        def profile_start():
+            interval = float(request.args.get('interval', 0.005))
+            return {'status': 'ok' if diagnostics.profiler.start(interval) else 'running'}
+
+        @app.route("/api/admin/profile/stop", methods=['POST', 'GET'])
+        def profile_stop():
+            return diagnostics.profiler.stop()
+
+        @app.route("/api/admin/profile")
+        def profile():
+            return diagnostics.profiler.collapsed()
+
+        @app.route("/api/admin/memory/start", methods=['POST', 'GET'])
+        def memory_start():
+            diagnostics.memory.start(int(request.args.get('frames', 5)))
+            return {'status': 'ok'}
+
+        @app.route("/api/admin/memory/stop", methods=['POST', 'GET'])
+        def memory_stop():
+            diagnostics.memory.stop()
+            return {'status': 'ok'}
+
+        @app.route("/api/admin/memory")
+        def memory():
+            return diagnostics.memory.snapshot(int(request.args.get('top', 20)))
+
+        @app.route("/api/admin/locks/start", methods=['POST', 'GET'])
+        def locks_start():
+            diagnostics.start_locks()
+            return {'status': 'ok'}
+
+        @app.route("/api/admin/locks/stop", methods=['POST', 'GET'])
+        def locks_stop():
+            diagnostics.stop_locks()
+            return diagnostics.lock_stats()
+
+        @app.route("/api/admin/locks")
+        def locks():
+            return diagnostics.lock_stats()
+
+        ## `file` is a plain name, captures live in DB_PATH/captures
+        @app.route("/api/admin/capture/start", methods=['POST', 'GET'])
+        def capture_start():
+            try:
+                diagnostics.start_capture(request.args.get('file'))
+            except ValueError as e:
+                return {'status': 'error', 'error': str(e)}, 400
+            return {'status': 'ok'}
+
+        @app.route("/api/admin/capture/stop", methods=['POST', 'GET'])
+        def capture_stop():
+            return diagnostics.stop_capture()
+
+        ## replay a capture through the parser and fan-out, speed 0 is as
+        ## fast as possible
+        @app.route("/api/admin/replay", methods=['POST', 'GET'])
+        def replay():
+            try:
+                path = diagnostics.capture_path(request.args.get('file'))
+            except ValueError as e:
+                return {'status': 'error', 'error': str(e)}, 400
+            return Replay(path,
+                          speed=float(request.args.get('speed', 1)),
+                          clients=int(request.args.get('clients', 50)),
+                          loops=int(request.args.get('loops', 1)),
+                          rules=tagoapi.rules).run()
 
     @app.route("/<path:path>")
     def static_files_root(path):
@@ -146,12 +400,32 @@ def run_server(bridge_url, http_port=5000, ws_port=8000, db_path='data', stop_ev
     MB_HOST = os.environ.get('MB_HOST', bridge_host)
     MB_PORT = int(os.environ.get('MB_PORT', bridge_port))
     DB_PATH = os.environ.get('DB_PATH', 'data')
+    RULES_FILE = os.environ.get('RULES_FILE', None)
+    DIAGNOSTICS = os.environ.get('DIAGNOSTICS', '0') == '1'
+    CAPTURE_FILE = os.environ.get('CAPTURE_FILE', None)
 
-    server = TagoEventServer('', WS_PORT, MB_HOST, MB_PORT, stop_event)
+    ## both the command and the event channel share one link so that an
+    ## outage seen by either one trips the breaker for both
+    link = BridgeLink(MB_HOST, MB_PORT, LinkSettings.from_env())
+
+    capture = CaptureWriter(CAPTURE_FILE) if CAPTURE_FILE else None
+    server = TagoEventServer('', WS_PORT, MB_HOST, MB_PORT, stop_event, link=link,
+                             capture=capture)
     server.serve()
 
-    tagoapi = TagoApi(host=MB_HOST, port=MB_PORT, dbpath=DB_PATH)
+    tagoapi = TagoApi(host=MB_HOST, port=MB_PORT, dbpath=DB_PATH, link=link,
+                      rules_path=RULES_FILE)
+    server.rules = tagoapi.rules
+    server.tracker = tagoapi.net.tracker
+    server.state = tagoapi.state
+    tagoapi.net.tracker.on_unconfirmed = server.report_unconfirmed
+    tagoapi.notify = server.broadcast
+
+    diagnostics = None
+    if DIAGNOSTICS:
+        diagnostics = Diagnostics(locks={'bus': tagoapi.net.lock}, server=server,
+                                  capture_dir=os.path.join(DB_PATH, 'captures'))
 
-    flask = threading.Thread(name='Front End', target=flask_thread, args=(tagoapi, HTTP_PORT))
+    flask = threading.Thread(name='Front End', target=flask_thread, args=(tagoapi, HTTP_PORT, diagnostics))
     flask.setDaemon(True)
     flask.start()
\ No newline at end of file
@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+
+
+class DeviceState(object):
+    """Last known live state of every device, checkpointed to the registry.
+
+    Channel levels come from 'D' events, the info block from getInfo().
+    Entries restored from the snapshot table are marked stale until fresh
+    data arrives, either from the bus traffic itself or from the low
+    priority revalidation worker.
+    """
+    CHECKPOINT_INTERVAL = 30
+    ## revalidation only runs after the bus has been quiet this long
+    IDLE_SECONDS = 2
+    REVALIDATE_PAUSE = 1
+
+    def __init__(self, api, table):
+        self.api = api
+        self.table = table
+        self.lock = threading.Lock()
+        self.states = {}
+        self.by_addr = {}
+        self.dirty = False
+        self.urgent = []
+        self.wakeup = threading.Event()
+        self.__restore()
+
+    def __restore(self):
+        for tid in self.table.keys():
+            s = self.table[tid]
+            s['levels_stale'] = True
+            s['info_stale'] = True
+            s['unreachable'] = False
+            self.states[tid] = s
+        logging.info(f'Restored state of {len(self.states)} devices')
+
+    def start(self):
+        threading.Thread(name='State Checkpoint', target=self.__checkpointer, daemon=True).start()
+        threading.Thread(name='State Revalidation', target=self.__revalidator, daemon=True).start()
+
+    ## map bus addresses to device ids, redone after a rescan
+    def reindex(self):
+        with self.lock:
+            self.by_addr = {self.api.devices[d]['addr']: d for d in self.api.devices}
+
+    def __entry(self, tid):
+        return self.states.setdefault(tid, {'levels': None, 'levels_ts': None, 'levels_stale': True,
+                                            'info': None, 'info_ts': None, 'info_stale': True,
+                                            'last_seen': None})
+
+    ## called from the event thread
+    def update_levels(self, addr, levels, ts):
+        tid = self.by_addr.get(addr)
+        if tid is None:
+            return
+        with self.lock:
+            s = self.__entry(tid)
+            s['levels'] = levels
+            s['levels_ts'] = ts
+            s['levels_stale'] = False
+            s['last_seen'] = ts
+            self.dirty = True
+
+    def update_info(self, tid, info):
+        now = int(time.time() * 1000)
+        with self.lock:
+            s = self.__entry(tid)
+            s['info'] = info
+            s['info_ts'] = now
+            s['info_stale'] = False
+            s['unreachable'] = False
+            s['last_seen'] = now
+            self.dirty = True
+
+    def seen(self, addr, ts):
+        tid = self.by_addr.get(addr)
+        if tid is None:
+            return
+        with self.lock:
+            self.__entry(tid)['last_seen'] = ts
+            self.dirty = True
+
+    def get(self, tid):
+        with self.lock:
+            s = dict(self.__entry(tid))
+        if s['info_stale']:
+            self.revalidate(tid)
+        if s['last_seen'] is not None:
+            s['age'] = round(time.time() - s['last_seen'] / 1000)
+        return s
+
+    def all(self):
+        return {tid: self.get(tid) for tid in list(self.api.devices.keys())}
+
+    ## move a device to the front of the revalidation queue
+    def revalidate(self, tid):
+        with self.lock:
+            if tid not in self.urgent:
+                self.urgent.append(tid)
+        self.wakeup.set()
+
+    ## write all entries in one transaction
+    def checkpoint(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = {tid: dict(s) for tid, s in self.states.items()}
+            self.dirty = False
+        for tid, s in snapshot.items():
+            self.table[tid] = s
+        self.table.commit()
+
+    def __checkpointer(self):
+        while True:
+            time.sleep(self.CHECKPOINT_INTERVAL)
+            try:
+                self.checkpoint()
+            except Exception as e:
+                logging.error(f'State checkpoint failed: {e}')
+
+    def __next_stale(self):
+        with self.lock:
+            if len(self.urgent):
+                return self.urgent.pop(0)
+            for tid, s in self.states.items():
+                if s['info_stale'] and not s.get('unreachable') and tid in self.by_addr.values():
+                    return tid
+        return None
+
+    def __revalidator(self):
+        while True:
+            tid = self.__next_stale()
+            if tid is None:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            ## stay out of the way of real traffic
+            while time.time() - self.api.last_exec_time < self.IDLE_SECONDS or self.api.net.lock.locked():
+                time.sleep(self.REVALIDATE_PAUSE)
+
+            try:
+                self.api.device_info(tid)
+            except Exception as e:
+                logging.error(f'Revalidating {tid} failed: {e}')
+                ## only retried when someone asks for the device
+                with self.lock:
+                    self.__entry(tid)['unreachable'] = True
+            time.sleep(self.REVALIDATE_PAUSE)
@@ -0,0 +1,200 @@
+import time
+import logging
+from collections import deque
+from threading import Lock
+
+## node 0 is used for bus wide requests (scans). Its gap is the slowest
+## of any node, its timeout is always the default.
+BUS = 0
+
+
+class KindTiming(object):
+    """Round trip times of one kind of request to one node."""
+    WINDOW = 200
+
+    def __init__(self, rtt=None):
+        self.samples = deque(rtt or [], maxlen=self.WINDOW)
+        self.timeout = None
+        self.dirty = True
+
+    def percentile(self, p):
+        data = sorted(self.samples)
+        return data[min(len(data) - 1, int(len(data) * p))]
+
+
+class NodeTiming(object):
+    def __init__(self, gap=None, rtt=None):
+        ## calibrated gap, None until measured
+        self.gap = gap
+        ## gap widened after misses, None while the node keeps up
+        self.widened = None
+        self.misses = 0
+        self.streak = 0
+        ## older tables kept one list for all requests, those samples mix
+        ## small reads with writes and are dropped
+        self.kinds = {k: KindTiming(v) for k, v in rtt.items()} if isinstance(rtt, dict) else {}
+
+
+class BusTiming(object):
+    """Per bridge and per node bus timing.
+
+    Timeouts are derived from the round trip times seen on the bus (p99 with
+    a safety factor), learned separately for each kind of request since a
+    2 register read and a firmware record take very different times. Gaps
+    come from calibrateTiming(), an uncalibrated node gets none, same as
+    plain pymodbus. Until a kind has enough samples, and for requests
+    without a kind (scans), the conservative default timeout is used.
+    Missed responses widen the node's gap and drop its learned timeouts
+    until it recovers. Once it answers again the widened gap decays back
+    to the calibrated one.
+    """
+    DEFAULT_TIMEOUT = 2
+    DEFAULT_GAP = 0
+    MAX_GAP = 0.3
+    MIN_WIDENED_GAP = 0.005
+    DECAY_AFTER = 20
+    DECAY_FACTOR = 0.75
+    MIN_TIMEOUT = 0.05
+    MIN_SAMPLES = 20
+    TIMEOUT_FACTOR = 2
+    TIMEOUT_MARGIN = 0.02
+    PERSIST_EVERY = 100
+
+    def __init__(self, table=None, default_timeout=DEFAULT_TIMEOUT, default_gap=DEFAULT_GAP):
+        self.table = table
+        self.default_timeout = default_timeout
+        self.default_gap = default_gap
+        self.lock = Lock()
+        self.nodes = {}
+        self.last_frame_end = 0
+        self.unsaved = 0
+        self.__load()
+
+    def __load(self):
+        if self.table is None:
+            return
+        for k in self.table.keys():
+            v = self.table[k]
+            self.nodes[int(k)] = NodeTiming(gap=v.get('gap'), rtt=v.get('rtt'))
+
+    def save(self):
+        if self.table is None:
+            return
+        with self.lock:
+            snapshot = {k: {'gap': n.gap, 'rtt': {kind: list(t.samples) for kind, t in n.kinds.items()}}
+                        for k, n in self.nodes.items()}
+            self.unsaved = 0
+        for k, v in snapshot.items():
+            self.table[str(k)] = v
+
+    def __node(self, node):
+        return self.nodes.setdefault(node, NodeTiming())
+
+    def is_calibrated(self, node):
+        n = self.nodes.get(node)
+        return n is not None and n.gap is not None
+
+    def __gap(self, n):
+        if n.widened is not None:
+            return n.widened
+        return self.default_gap if n.gap is None else n.gap
+
+    def gap(self, node):
+        with self.lock:
+            if node == BUS:
+                gaps = [self.__gap(n) for k, n in self.nodes.items() if k != BUS]
+                return max(gaps + [self.default_gap])
+            n = self.nodes.get(node)
+            return self.default_gap if n is None else self.__gap(n)
+
+    ## the calibrated gap alone, None if the node was never calibrated
+    def calibrated_gap(self, node):
+        with self.lock:
+            n = self.nodes.get(node)
+            return None if n is None else n.gap
+
+    def set_gap(self, node, gap):
+        with self.lock:
+            n = self.__node(node)
+            n.gap = gap
+            n.widened = None
+
+    ## `kind` names the request, e.g. 'read_holding_registers/2'. None
+    ## (scans, address changes) always gets the default, a scan stops at the
+    ## first reply that does not come in time.
+    def timeout(self, node, kind=None):
+        if node == BUS or kind is None:
+            return self.default_timeout
+        with self.lock:
+            n = self.nodes.get(node)
+            t = n.kinds.get(kind) if n is not None else None
+            if t is None or n.misses or len(t.samples) < self.MIN_SAMPLES:
+                return self.default_timeout
+            if t.dirty:
+                t.timeout = min(self.default_timeout,
+                                max(self.MIN_TIMEOUT,
+                                    t.percentile(0.99) * self.TIMEOUT_FACTOR + self.TIMEOUT_MARGIN))
+                t.dirty = False
+            return t.timeout
+
+    ## sleep for whatever is left of the inter-frame gap
+    def wait_gap(self, node):
+        delay = self.last_frame_end + self.gap(node) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    ## a frame went out without waiting for its response
+    def sent(self):
+        with self.lock:
+            self.last_frame_end = time.monotonic()
+
+    def observe(self, node, rtt, ok, adapt=True, kind=None):
+        save = False
+        with self.lock:
+            self.last_frame_end = time.monotonic()
+            if node == BUS:
+                return
+            n = self.__node(node)
+            if ok:
+                n.misses = 0
+                n.streak += 1
+                ## a node that keeps up again gets its gap back step by step
+                if n.widened is not None and n.streak >= self.DECAY_AFTER:
+                    n.streak = 0
+                    base = self.default_gap if n.gap is None else n.gap
+                    n.widened *= self.DECAY_FACTOR
+                    if n.widened <= max(base * 1.1, base + 0.001):
+                        n.widened = None
+                        logging.info(f'Gap for 0x{node:02x} back to {base * 1000:.1f}ms')
+                if kind is not None:
+                    t = n.kinds.setdefault(kind, KindTiming())
+                    t.samples.append(rtt)
+                    t.dirty = True
+                    self.unsaved += 1
+                    save = self.unsaved >= self.PERSIST_EVERY
+            elif adapt:
+                n.misses += 1
+                n.streak = 0
+                ## a node that answered before and now does not gets more
+                ## room, up to MAX_GAP
+                if len(n.kinds) and n.misses <= 3:
+                    n.widened = min(self.MAX_GAP, max(self.__gap(n) * 1.5, self.MIN_WIDENED_GAP))
+                    logging.info(f'Widening gap for 0x{node:02x} to {n.widened * 1000:.1f}ms')
+        if save:
+            self.save()
+
+    def stats(self):
+        res = {}
+        for node in list(self.nodes.keys()):
+            with self.lock:
+                n = self.nodes[node]
+                kinds = {kind: {
+                    'samples': len(t.samples),
+                    'rtt_p50_ms': round(t.percentile(0.5) * 1000, 1) if len(t.samples) else None,
+                    'rtt_p99_ms': round(t.percentile(0.99) * 1000, 1) if len(t.samples) else None,
+                } for kind, t in list(n.kinds.items())}
+                res[f'0x{node:02x}'] = {'misses': n.misses, 'requests': kinds}
+            for kind, k in kinds.items():
+                k['timeout_ms'] = round(self.timeout(node, kind) * 1000, 1)
+            res[f'0x{node:02x}']['gap_ms'] = round(self.gap(node) * 1000, 1)
+        return res
@@ -0,0 +1,126 @@
+import time
+import logging
+import threading
+from collections import deque
+
+## TagoDevice.Actions values
+RAMP_TO   = 1
+RAMP_UP   = 2
+RAMP_DOWN = 3
+
+
+class ActionTracker(object):
+    """Confirms actions that were sent without waiting for a response.
+
+    A node reports its channel levels with a 'D' event after it carries out
+    an action. RAMP_TO is confirmed once the channel reports the target
+    level. The other actions are confirmed when the channel's level moves
+    away from the one last reported before the action was sent, or sits at
+    the end a ramp goes to. Without an earlier report any level of the
+    channel confirms them. Actions still pending after `deadline` seconds
+    are reported through `on_unconfirmed` and kept in a short history.
+    """
+    HISTORY = 100
+
+    def __init__(self, deadline=2.0, on_unconfirmed=None):
+        self.deadline = deadline
+        self.on_unconfirmed = on_unconfirmed
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}
+        ## last reported level per node and channel, in percent
+        self.levels = {}
+        self.unconfirmed = deque(maxlen=self.HISTORY)
+        self.stats = {'sent': 0, 'confirmed': 0, 'unconfirmed': 0, 'avg_confirm_ms': 0}
+        self.thread = None
+
+    ## `channel`, `action` and `value` (0 to 255) of the action sent to node
+    def expect(self, node, channel, action, value, **extra):
+        now = time.monotonic()
+        with self.lock:
+            before = self.levels.get(node, {}).get(channel)
+            self.pending.setdefault(node, []).append(dict(extra, node=node, channel=channel,
+                                                          action=action, value=value,
+                                                          before=before, sent=now,
+                                                          ts=int(time.time() * 1000)))
+            self.stats['sent'] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(name='Action Tracker', target=self.__reaper, daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    @staticmethod
+    def __matches(action, levels):
+        level = levels.get(action['channel'])
+        if level is None:
+            return False
+        if action['action'] == RAMP_TO:
+            return abs(level - int((action['value'] * 100) / 255)) <= 1
+        if (action['action'] == RAMP_UP and level >= 100) or \
+           (action['action'] == RAMP_DOWN and level <= 0):
+            return True
+        return action['before'] is None or level != action['before']
+
+    ## called from the event thread for every 'D' event with its channel
+    ## states. Returns the number of actions it confirmed.
+    def confirm(self, node, state):
+        now = time.monotonic()
+        levels = {s['ch']: s['value'] for s in state}
+        with self.lock:
+            self.levels.setdefault(node, {}).update(levels)
+            actions = self.pending.get(node)
+            if not actions:
+                return 0
+            confirmed = [a for a in actions if self.__matches(a, levels)]
+            if len(confirmed) == len(actions):
+                del self.pending[node]
+            else:
+                self.pending[node] = [a for a in actions if a not in confirmed]
+            for a in confirmed:
+                self.stats['confirmed'] += 1
+                latency = (now - a['sent']) * 1000
+                self.stats['avg_confirm_ms'] += (latency - self.stats['avg_confirm_ms']) / self.stats['confirmed']
+        return len(confirmed)
+
+    def expire(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            for node in list(self.pending.keys()):
+                actions = self.pending[node]
+                while len(actions) and now - actions[0]['sent'] >= self.deadline:
+                    a = actions.pop(0)
+                    expired.append({k: v for k, v in a.items() if k not in ('sent', 'before')})
+                if not len(actions):
+                    del self.pending[node]
+            self.stats['unconfirmed'] += len(expired)
+            self.unconfirmed.extend(expired)
+
+        for a in expired:
+            logging.warning(f'Action on 0x{a["node"]:02x} was not confirmed: {a}')
+        if len(expired) and self.on_unconfirmed is not None:
+            try:
+                self.on_unconfirmed(expired)
+            except Exception as e:
+                logging.error(f'Reporting unconfirmed actions failed: {e}')
+        return expired
+
+    ## sleeps until the oldest pending action is due
+    def __reaper(self):
+        while True:
+            with self.lock:
+                oldest = [a[0]['sent'] for a in self.pending.values() if len(a)]
+            if len(oldest):
+                self.wakeup.wait(max(0, min(oldest) + self.deadline - time.monotonic()))
+            else:
+                self.wakeup.wait()
+            self.wakeup.clear()
+            self.expire()
+
+    def status(self):
+        with self.lock:
+            res = dict(self.stats)
+            res['avg_confirm_ms'] = round(res['avg_confirm_ms'], 1)
+            res['pending'] = sum(len(a) for a in self.pending.values())
+            res['recent_unconfirmed'] = list(self.unconfirmed)
+        return res